@@ -0,0 +1,133 @@
+"""ベンチマーク用の合成コーパスを作る
+
+同じscaleとseedからは同じ内容のファイルができるので、コミット間で結果を比較できる。
+
+    $ python benchmarks/corpus.py /tmp/ezlite-bench --scale 1
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import shutil
+
+# scale=1のときのファイル数と大きさ
+N_PY_FILES = 2000
+N_TXT_FILES = 2000
+N_NOTEBOOKS = 20
+N_CELLS = 200
+PY_LINES = 120
+TXT_LINES = 200
+# ノートブックの出力に埋め込む画像の大きさ(バイト)
+IMAGE_BYTES = 64 << 10
+
+# 検索する単語. ファイルの一部にだけ含まれるようにする
+NEEDLE = "needle_token"
+NEEDLE_RATE = 0.01
+
+WORDS = [
+    "data", "frame", "value", "index", "result", "config", "path", "count",
+    "日本語", "売上", "顧客", "集計", "確認", "テスト",
+]
+
+
+def random_line(rng, n_words=8):
+    line = " ".join(rng.choice(WORDS) for _ in range(n_words))
+    if rng.random() < NEEDLE_RATE:
+        line += " " + NEEDLE
+    return line
+
+
+def py_source(rng, n_lines):
+    lines = ["import os", "import sys", ""]
+    for i in range(n_lines):
+        if i % 10 == 0:
+            lines.append(f"def func_{i}(x):")
+        lines.append(f"    # {random_line(rng)}")
+        lines.append(f"    x = x + {i}")
+    return "\n".join(lines) + "\n"
+
+
+def notebook(rng, n_cells):
+    image = rng.getrandbits(IMAGE_BYTES * 8).to_bytes(IMAGE_BYTES, "little")
+    image = base64.b64encode(image).decode("ascii")
+    cells = []
+    for i in range(n_cells):
+        if i % 5 == 0:
+            cells.append(
+                {
+                    "cell_type": "markdown",
+                    "metadata": {},
+                    "source": [f"# {random_line(rng)}\n", random_line(rng)],
+                }
+            )
+            continue
+        source = [f"x_{i} = '{random_line(rng)}'\n" for _ in range(5)]
+        source[-1] = source[-1].rstrip("\n")
+        outputs = [
+            {
+                "name": "stdout",
+                "output_type": "stream",
+                "text": [random_line(rng) + "\n" for _ in range(20)],
+            }
+        ]
+        if i % 20 == 1:
+            # 画像を含む大きな出力
+            outputs.append(
+                {
+                    "data": {"image/png": image, "text/plain": ["<Figure>"]},
+                    "metadata": {},
+                    "output_type": "display_data",
+                }
+            )
+        cells.append(
+            {
+                "cell_type": "code",
+                "execution_count": i,
+                "metadata": {},
+                "outputs": outputs,
+                "source": source,
+            }
+        )
+    return {"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 5}
+
+
+def make_corpus(root, scale=1.0, seed=0):
+    """rootに.py, .txt, .ipynbのファイルを作る. 作成済みの場合は作り直さない"""
+    stamp_path = os.path.join(root, ".corpus.json")
+    stamp = {"scale": scale, "seed": seed}
+    try:
+        with open(stamp_path, encoding="utf-8") as f:
+            if json.load(f) == stamp:
+                return root
+    except (OSError, ValueError):
+        pass
+    shutil.rmtree(root, ignore_errors=True)
+    rng = random.Random(seed)
+    for i in range(int(N_PY_FILES * scale)):
+        dirname = os.path.join(root, "src", f"pkg{i % 50}")
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, f"mod{i}.py"), "w", encoding="utf-8") as f:
+            f.write(py_source(rng, PY_LINES))
+    for i in range(int(N_TXT_FILES * scale)):
+        dirname = os.path.join(root, "docs", f"dir{i % 50}")
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, f"doc{i}.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(random_line(rng) for _ in range(TXT_LINES)) + "\n")
+    dirname = os.path.join(root, "notebooks")
+    os.makedirs(dirname, exist_ok=True)
+    for i in range(max(int(N_NOTEBOOKS * scale), 1)):
+        with open(os.path.join(dirname, f"nb{i}.ipynb"), "w", encoding="utf-8") as f:
+            json.dump(notebook(rng, N_CELLS), f, indent=1, ensure_ascii=False)
+    with open(stamp_path, "w", encoding="utf-8") as f:
+        json.dump(stamp, f)
+    return root
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    make_corpus(args.root, scale=args.scale, seed=args.seed)
@@ -0,0 +1,269 @@
+"""ezliteのよく使う処理の実行時間とピークメモリを計測する
+
+合成コーパスを作り(2回目以降は再利用)、各ベンチマークの実行時間(最小値と中央値)と
+tracemallocで測ったピークメモリをbenchmarks/results/<コミット>.jsonに保存する。
+
+    $ python benchmarks/run.py                   # すべて実行
+    $ python benchmarks/run.py -k sniff          # 名前に"sniff"を含むものだけ実行
+    $ python benchmarks/run.py --compare abc1234 # 保存済みの結果と比較する
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ezlite
+from ezlite import utils
+
+from corpus import NEEDLE, make_corpus
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+# sniffのenvironに渡す環境変数
+CORPUS_ENV = "EZLITE_BENCH_CORPUS"
+
+BENCHMARKS = {}
+
+
+def bench(name):
+    """ベンチマークを登録する. 関数は準備をして計測する処理(引数なし)を返す"""
+
+    def _register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return _register
+
+
+def corpus_files(ctx, ext):
+    return [
+        os.path.join(dirpath, name)
+        for dirpath, _, names in os.walk(ctx["corpus"])
+        for name in sorted(names)
+        if name.endswith(ext)
+    ]
+
+
+# sniffはlimit=Noneにして、表示件数で打ち切らずに全ファイルを検索する
+@bench("sniff_py")
+def _(ctx):
+    return lambda: ezlite.sniff(NEEDLE, "src/**/*.py", environ=CORPUS_ENV, limit=None)
+
+
+@bench("sniff_txt_regex")
+def _(ctx):
+    return lambda: ezlite.sniff(
+        [NEEDLE, r"売上\s+顧客"],
+        "docs/**/*.txt",
+        regex=True,
+        environ=CORPUS_ENV,
+        limit=None,
+    )
+
+
+@bench("sniff_ipynb")
+def _(ctx):
+    return lambda: ezlite.sniff(NEEDLE, "notebooks/*.ipynb", environ=CORPUS_ENV, limit=None)
+
+
+@bench("get_lines_ipynb")
+def _(ctx):
+    paths = corpus_files(ctx, ".ipynb")
+    return lambda: [utils.get_lines(path) for path in paths]
+
+
+@bench("get_matched_idxs")
+def _(ctx):
+    lines = [l for path in corpus_files(ctx, ".txt")[:200] for l in utils.get_lines(path)]
+    return lambda: utils.get_matched_idxs(lines, NEEDLE)
+
+
+@bench("merge_neighbors")
+def _(ctx):
+    idxs = list(range(0, 2_000_000, 7))
+    return lambda: utils.merge_neighbors(idxs, 2, n_lines=2_000_000)
+
+
+@bench("j_large")
+def _(ctx):
+    code = "\n".join(
+        f"df_{i} = df[df['カラム{i}'] == 売上] # 顧客の集計 {i}" for i in range(50_000)
+    )
+    return lambda: utils.quote_jp(code)
+
+
+@bench("multi_replace_many_keys")
+def _(ctx):
+    mapping = {f"key{i}": f"value{i}" for i in range(200)}
+    text = " ".join(f"key{i % 300}" for i in range(50_000))
+    return lambda: utils.multi_replace(text, mapping)
+
+
+@bench("history_long_session")
+def _(ctx):
+    session = {f"_i{i}": f"x_{i % 5000} = {i}" for i in range(1, 50_001)}
+
+    def _run():
+        # historyは最後の要素を取り除くので毎回コピーを渡す
+        _locals = dict(session)
+        _locals["_"] = None
+        ezlite.history(_locals, n=20)
+
+    return _run
+
+
+def write_bench(ctx, **options):
+    try:
+        import pandas as pd
+    except ImportError:
+        return None
+    df = pd.DataFrame(
+        {
+            "a": range(200_000),
+            "b": [f"売上{i % 100}" for i in range(200_000)],
+            "c": [i * 0.5 for i in range(200_000)],
+        }
+    )
+    path = os.path.join(ctx["tmpdir"], "out.csv")
+    if options.get("cache") is True:
+        # 利用者の~/.ezlite/write_cache.jsonと集計値を書き換えないようにする
+        utils.WRITE_CACHE_PATH = os.path.join(ctx["tmpdir"], "write_cache.json")
+        utils.write_cache_stats.update(hits=0, misses=0)
+
+    def _run():
+        ezlite.df_write_option(prefix="bench_", **options)
+        try:
+            df.to_csv(path)
+        finally:
+            utils.df_reset_write_option()
+
+    return _run
+
+
+@bench("df_write_option_csv")
+def _(ctx):
+    return write_bench(ctx)
+
+
+@bench("df_write_option_cached")
+def _(ctx):
+    return write_bench(ctx, cache=True)
+
+
+def measure(func, repeat):
+    """実行時間(秒)のリストとピークメモリ(バイト)を返す"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        # 1回目はキャッシュなどの準備を含むので除外する
+        func()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        # tracemallocは処理が遅くなるので時間とは別に計測する
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return times, peak
+
+
+def current_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def print_results(results, baseline=None):
+    print(f"{'name':<28}{'min(ms)':>12}{'median(ms)':>12}{'peak(MiB)':>12}")
+    for name, r in results.items():
+        line = f"{name:<28}{r['min'] * 1e3:>12.2f}{r['median'] * 1e3:>12.2f}{r['peak'] / 2**20:>12.2f}"
+        if (baseline is not None) and (name in baseline):
+            line += f"{r['min'] / baseline[name]['min']:>8.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-k", dest="keyword", default="", help="名前にこの文字列を含むものだけ実行する")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="コーパスの大きさ")
+    parser.add_argument(
+        "--corpus",
+        default=os.path.join(tempfile.gettempdir(), "ezlite-bench-corpus"),
+        help="コーパスを作るディレクトリ",
+    )
+    parser.add_argument("--compare", help="比較するコミット(results/<コミット>.json)")
+    args = parser.parse_args()
+
+    make_corpus(args.corpus, scale=args.scale)
+    os.environ[CORPUS_ENV] = args.corpus
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ctx = {"corpus": args.corpus, "tmpdir": tmpdir}
+        for name, setup in BENCHMARKS.items():
+            if args.keyword not in name:
+                continue
+            func = setup(ctx)
+            if func is None:
+                print(f"{name}: 必要なライブラリがないためスキップしました。")
+                continue
+            times, peak = measure(func, args.repeat)
+            results[name] = {
+                "min": min(times),
+                "median": statistics.median(times),
+                "peak": peak,
+                "times": times,
+            }
+
+    commit = current_commit()
+    report = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out_path = os.path.join(RESULTS_DIR, f"{commit}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(RESULTS_DIR, f"{args.compare}.json"), encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    print(f"結果を{out_path}に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
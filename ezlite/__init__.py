@@ -1,13 +1,41 @@
-from .ezlite import (
-    df_viewer,
-    df_write_option,
-    history,
-    j,
-    lsplit,
-    msort,
-    psplit,
-    sniff,
-    template,
-    todt,
-    upgrade,
-)
+# 使う関数を最初に参照したときにezlite.ezliteを読み込む
+__all__ = [
+    "batch",
+    "df_viewer",
+    "df_write_option",
+    "flush_writes",
+    "get_sink",
+    "history",
+    "iter_sniff",
+    "j",
+    "lsplit",
+    "msort",
+    "msort_tree",
+    "psplit",
+    "psplit_many",
+    "record_history",
+    "register_sniff_hook",
+    "set_sink",
+    "sniff",
+    "sniff_index",
+    "template",
+    "todt",
+    "todt_apply",
+    "upgrade",
+    "write_cache_info",
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from . import ezlite
+
+        value = getattr(ezlite, name)
+        # 2回目以降は__getattr__を通らないようにする
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,70 +1,186 @@
-import glob
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
 from functools import partial
-from itertools import tee
 import subprocess
-import time
-from typing import List
-
-import isort
-from pandas import DataFrame
-import pyperclip
+import tempfile
+import threading
+from typing import TYPE_CHECKING, List
+import webbrowser
 
+from . import utils
 from .utils import *
 
+if TYPE_CHECKING:
+    # pandasのimportは時間がかかるので、型ヒントだけに使う
+    from pandas import DataFrame
+
 upgrade = partial(pNc, code=INSTALL_CMD)
 template = partial(pNc, code=TEMPLATE)
 
-def history(_locals, word=None, n=20, desc=True) -> str:
-    """Jupyterで過去に実行したコードを出力する(カーネル再起動によりログは失われる)"""
-    _locals.popitem()
-    i_codes = [v for k, v in _locals.items() if re.findall(r'_i[0-9]+', k)]
-    if desc:
-        i_codes.reverse()
-    if word is not None:
-        i_codes = [c for c in i_codes[:n] if word in c]
-    if not i_codes:
+def history(_locals=None, word=None, n=20, desc=True, *, db_path=None) -> str:
+    """Jupyterで過去に実行したコードを出力する
+
+    _localsを渡した場合はJupyterの_iN変数から取得する(カーネル再起動によりログは失われる)。
+    _localsを省略した場合はrecord_historyで記録したDBから検索する。
+    """
+    if _locals is None:
+        with closing(open_history_db(db_path)) as con:
+            o_codes = query_history(con, word=word, n=n, desc=desc)
+    else:
+        _locals.popitem()
+        i_codes = [v for k, v in _locals.items() if re.findall(r'_i[0-9]+', k)]
+        if desc:
+            i_codes.reverse()
+        if word is not None:
+            i_codes = [c for c in i_codes[:n] if word in c]
+        # 重複を除外(最初に出てきた順番を保つ)
+        o_codes = list(dict.fromkeys(i_codes))
+    if not o_codes:
         return
-    o_codes = list()
-    for code in i_codes:
-        if bool(o_codes) & (code in o_codes):
-            pass
-        else:
-            o_codes.append(code)
     o_codes = [">>>\n" + c for c in o_codes]
     code = ("\n\n").join(o_codes)
     print(code)
 
+
+def record_history(ip=None, *, db_path=None, enable=True) -> None:
+    """Jupyterで実行したセルをDBに記録する(カーネルを再起動してもhistoryで検索できる)
+
+    Args:
+        ip (_type_, optional): IPythonのシェル. 省略した場合は実行中のシェル Defaults to None.
+        db_path (str, optional): 記録先のDBのパス Defaults to None.
+        enable (bool, optional): Falseの場合は記録を停止する Defaults to True.
+
+    Returns:
+        _type_: None
+    """
+    if ip is None:
+        from IPython import get_ipython
+
+        ip = get_ipython()
+    if ip is None:
+        print("IPythonの外では記録できません。")
+        return None
+    # 登録済みの記録を解除してから登録し直す
+    recorder = getattr(ip, "_ezlite_history_recorder", None)
+    if recorder is not None:
+        ip.events.unregister("post_run_cell", recorder)
+        recorder.con.close()
+        ip._ezlite_history_recorder = None
+    if enable is True:
+        recorder = HistoryRecorder(ip, open_history_db(db_path))
+        ip.events.register("post_run_cell", recorder)
+        ip._ezlite_history_recorder = recorder
+    return None
+
+
 def df_viewer(
-    df: DataFrame,
+    df: "DataFrame",
     *,
     head: int = 100,
     tail: int = None,
     columns: List[str] = None,
+    server: bool = False,
+    page_size: int = 100,
+    profile: bool = False,
+    sample: int = None,
 ):
+    """DataFrameをブラウザで表示する
+
+    Args:
+        df (DataFrame): 表示するDataFrame
+        head (int, optional): 先頭から表示する行数 Defaults to 100.
+        tail (int, optional): headのうち末尾から表示する行数 Defaults to None.
+        columns (List[str], optional): 表示するカラム Defaults to None.
+        server (bool, optional): ローカルのHTTPサーバーで全行をページごとに表示する.
+            並べ替えと絞り込みはサーバー側で行い、表示するページの分だけHTMLにする.
+            サーバーは1つを使い回すので、前に表示したDataFrameは新しいものに置き換わる Defaults to False.
+        page_size (int, optional): server=Trueの場合の1ページの行数 Defaults to 100.
+        profile (bool, optional): カラムごとの型、欠損数、異なる値の数、最小値、最大値、
+            頻出値を行の上に表示する. 同じ内容のDataFrameは前回の結果を使う Defaults to False.
+        sample (int, optional): profileを計算するときにサンプリングする行数 Defaults to None.
+
+    Returns:
+        _type_: None
+    """
+    # カラムごとの統計量をHTMLにする
+    profile_html = ""
+    if profile is True:
+        _df = df if columns is None else df[columns]
+        profile_html = profile_frame(_df, sample=sample).to_html()
+
+    if server is True:
+        # 別スレッドでサーバーを起動してすぐに戻る
+        url = serve_dataframe(
+            df, columns=columns, page_size=page_size, profile_html=profile_html
+        )
+        print(f"{url} で表示しています。")
+        webbrowser.open(url)
+        return None
+
     # dfをhtmlに出力
     if columns is not None:
         df = df[columns].copy()
     df = df.head(head).copy()
     if tail is not None:
         df = df.tail(tail).copy()
-    html_path = "df_viewer.html"
-    df.to_html(html_path)
+    # 続けて呼び出しても上書きや削除をし合わないように、呼び出すごとに別のファイルにする
+    fd, html_path = tempfile.mkstemp(prefix="df_viewer_", suffix=".html")
+    with open(fd, "w", encoding="utf-8") as f:
+        f.write(profile_html)
+        df.to_html(f)
 
     # htmlをopen
     if platform.system() == "Windows":
         os.startfile(html_path)
     else:
         subprocess.call(["open", html_path])
-    time.sleep(5)
-    os.remove(html_path)
+    # ブラウザが読み込んだ後に削除する(待たずに戻る)
+    threading.Timer(5, remove_file, args=[html_path]).start()
     return None
 
 
-def df_write_option(dirname=None, *, prefix="", suffix="", skip=False):
+def df_write_option(
+    dirname=None,
+    *,
+    prefix="",
+    suffix="",
+    skip=False,
+    background=False,
+    max_pending=8,
+    format=None,
+    compression=None,
+    chunksize=None,
+    cache=False,
+):
+    """DataFrame.to_csvとto_excelの出力先を書き換える
+
+    Args:
+        dirname (str, optional): デスクトップに作るフォルダ名. 指定した場合はそこに出力する Defaults to None.
+        prefix (str, optional): ファイル名の先頭に付ける文字列 Defaults to "".
+        suffix (str, optional): ファイル名の末尾(拡張子の前)に付ける文字列 Defaults to "".
+        skip (bool, optional): ファイルを出力しない Defaults to False.
+        background (bool, optional): 別スレッドで出力してすぐに戻る. 戻り値はFutureになる.
+            出力するのは呼び出した時点のコピーなので、その後にDataFrameを変更しても影響しない Defaults to False.
+        max_pending (int, optional): background=Trueの場合に出力待ちにできる数. 超えると空くまで待つ Defaults to 8.
+        format (str, optional): to_csvの出力形式. "parquet"か"feather"を指定すると拡張子を変えてその形式で出力する.
+            to_csvの引数はindexとcolumnsだけを使い、sepやheaderなどcsv用の引数は警告して無視する Defaults to None.
+        compression (str, optional): to_csvの出力の圧縮形式. parquetは"snappy"や"zstd"、csvは"gzip"など Defaults to None.
+        chunksize (int, optional): csvを何行ずつ書き込むか. 指定した行数分しかメモリに展開しない Defaults to None.
+        cache (bool, optional): 前回と同じ内容・引数で出力済みのファイルは出力しない.
+            出力後にファイルが変更された場合は出力し直す. 結果はwrite_cache_infoで確認できる Defaults to False.
+
+    Returns:
+        _type_: None
+    """
+    from pandas import DataFrame
+
+    # 最初の呼び出しでto_csvとto_excelを保存し、以降は保存したものに戻してから書き換える
     df_reset_write_option()
+    if background is True:
+        set_write_queue(max_pending)
 
-    def modify_path_or_buf(func):
+    def modify_path_or_buf(func, is_csv=False):
         def wrapper(self, path_or_buf, *args, **kwargs):
             if skip is True:
                 print("ファイル出力をスキップしました。")
@@ -73,24 +189,152 @@ def df_write_option(dirname=None, *, prefix="", suffix="", skip=False):
                 modified_path_or_buf = modify_path(
                     path_or_buf, dirname=dirname, prefix=prefix, suffix=suffix
                 )
-                return func(self, modified_path_or_buf, *args, **kwargs)
+                write = func
+                if is_csv is True:
+                    # 出力形式や圧縮、チャンクの指定に合わせて書き込み方法を切り替える
+                    write, modified_path_or_buf, args, kwargs = route_csv_write(
+                        func,
+                        modified_path_or_buf,
+                        args,
+                        kwargs,
+                        format=format,
+                        compression=compression,
+                        chunksize=chunksize,
+                    )
+                if cache is True:
+                    # 内容が同じなら出力をスキップする
+                    write = cached_write(write, func.__name__)
+                if background is True:
+                    return submit_write(
+                        write, self.copy(), modified_path_or_buf, *args, **kwargs
+                    )
+                return write(self, modified_path_or_buf, *args, **kwargs)
 
         return wrapper
 
-    DataFrame.to_csv = modify_path_or_buf(DataFrame.to_csv)
+    DataFrame.to_csv = modify_path_or_buf(DataFrame.to_csv, is_csv=True)
     DataFrame.to_excel = modify_path_or_buf(DataFrame.to_excel)
     return None
 
 
+def write_cache_info() -> dict:
+    """df_write_option(cache=True)で出力をスキップした数(hits)と出力した数(misses)を返す"""
+    return dict(write_cache_stats)
+
+
+def flush_writes() -> None:
+    """df_write_option(background=True)で出力待ちのファイルをすべて出力し終わるまで待つ
+
+    失敗したものがあればRuntimeErrorを送出する。
+    """
+    errors = wait_writes()
+    if errors:
+        raise RuntimeError(f"{len(errors)}件のファイル出力に失敗しました。") from errors[0]
+    return None
+
+
+def set_sink(sink="clipboard", /, **kwargs) -> None:
+    """lsplitやpsplitなどで生成したコードの出力先(pp=Trueの場合)を切り替える
+
+    Args:
+        sink (str | object): "clipboard", "file", "buffer", "null"のいずれか.
+            write(code)とflush(timeout=None)を持つオブジェクトも指定できる Defaults to "clipboard".
+        **kwargs: 出力先に渡す引数. "file"はpath、"clipboard"はbackend(pyperclip.copyの代わりに呼ぶ関数)
+
+    Returns:
+        _type_: None
+    """
+    if isinstance(sink, str):
+        if sink not in SINKS:
+            raise ValueError(f"sinkは{tuple(SINKS)}のいずれかを指定してください: {sink}")
+        sink = SINKS[sink](**kwargs)
+    # 切り替える前の出力先のコピー待ちを終わらせる
+    get_sink().flush()
+    utils.output_sink = sink
+    return None
+
+
+def get_sink():
+    """現在の出力先を返す. "buffer"の場合はgetvalue()で出力した内容を取得できる"""
+    return utils.output_sink
+
+
 def msort(code=None, pp=True) -> None:
     """import文をsortする関数"""
+    import isort
+
     if code is None:
-        code = pyperclip.paste()
+        code = paste_clipboard()
     sorted_code = isort.code(code=code)
     pNc(code=sorted_code, pp=pp)
     return None
 
 
+def msort_tree(
+    root,
+    /,
+    include=("**/*.py", "**/*.ipynb"),
+    *,
+    exclude=None,
+    workers=None,
+    cache=True,
+) -> None:
+    """ディレクトリ以下の.pyファイルとノートブックのコードセルのimport文をsortして上書きする
+
+    前回から変わっていないファイルはキャッシュでスキップし、残りをプロセスで並列に処理する。
+    isortの設定はrootにあるpyproject.tomlなどを使い、設定を変えた場合はすべてのファイルを処理し直す。
+
+    Args:
+        root (str): 対象のディレクトリ
+        include (tuple, optional): rootからの相対パスのパターン Defaults to ("**/*.py", "**/*.ipynb").
+        exclude (list, optional): 除外するファイルやディレクトリのパターン Defaults to None.
+        workers (int, optional): 並列に処理するプロセスの数 Defaults to None.
+        cache (bool, optional): 変更のないファイルをスキップするかどうか Defaults to True.
+
+    Returns:
+        _type_: None
+    """
+    root = os.path.abspath(root)
+    if isinstance(include, str):
+        include = [include]
+    # 複数のパターンにマッチしたファイルは1回だけ処理する
+    paths = dict.fromkeys(
+        path
+        for pattern in include
+        for path in walk_paths(pattern, exclude=exclude, root=root)
+    )
+    config = isort_config(root)
+    config_digest = isort_config_digest(config)
+    msort_cache = load_msort_cache() if cache else {}
+    targets = [
+        p for p in paths if not is_sorted_cached(p, msort_cache.get(p), config_digest)
+    ]
+    sort_file = partial(sort_imports_file, config=config)
+    if len(targets) <= MSORT_SERIAL_MAX:
+        results = [sort_file(path) for path in targets]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(targets) // ((workers or os.cpu_count() or 1) * 4))
+            results = list(executor.map(sort_file, targets, chunksize=chunksize))
+    n_changed = 0
+    for path, changed, signature, digest, error in results:
+        if error is not None:
+            print(f"{path}: {error}")
+            msort_cache.pop(path, None)
+            continue
+        n_changed += changed
+        # 整形に使った設定も記録して、設定が変わったら整形し直す
+        msort_cache[path] = [signature, digest, config_digest]
+    if cache:
+        save_msort_cache(msort_cache)
+    print(
+        f"対象ファイル数は{len(paths)}件、"
+        f"そのうち{len(paths) - len(targets)}件はキャッシュでスキップし、"
+        f"{n_changed}件を書き換えました。"
+    )
+    return None
+
+
 def lsplit(text: str, *, multiline=True, pp=True) -> None:
     """三連引用符を使った複数行にわたる文字列をリストに変換する
 
@@ -102,14 +346,7 @@ def lsplit(text: str, *, multiline=True, pp=True) -> None:
     Returns:
         _type_: None
     """
-    # 改行文字で分割
-    text_li = text.strip().split("\n")
-    # 0文字のものは除外し、クォーテーションを付ける
-    text_li = [repr(t) for t in text_li if len(t) != 0]
-    # 結合して文字列にする
-    obj = (",").join(text_li)
-    # codeに変換
-    code = shape_code(obj, left="[", right="]", multiline=multiline)
+    code = lsplit_code(text, multiline=multiline)
     pNc(code, pp=pp)
     return None
 
@@ -123,6 +360,7 @@ def todt(
     sep="-",
     new_col=None,
     error_handling=True,
+    runtime=False,
     pp=True,
 ) -> None:
     """DataFrameとカラム名を受け取ってdatetime型に変換するコードを生成する
@@ -134,31 +372,68 @@ def todt(
         sep (str, optional): 変換前のカラム名の区切り文字。ない場合は""とする Defaults to "-".
         new_col (str, optional): 新しくカラムを作るときは入力する Defaults to None.
         error_handling (bool, optional): errors='coerce'のオプションをつけるかどうか Defaults to True.
+        runtime (bool, optional): pd.to_datetimeの代わりにtodt_applyを使うコードにするかどうか Defaults to False.
         pp (bool, optional): クリップボードにコピーするかどうか Defaults to True.
 
     Returns:
         _type_: None
     """
-    # 変換対象のカラム
-    old_srs = f"{df_name}['{col}']"
-    if new_col is None:
-        new_srs = old_srs
-    else:
-        new_srs = f"{df_name}['{new_col}']"
-    # 日付形式
-    format = fmt.replace("y", "Y")
-    format = sep.join(["%" + s for s in list(format)])
-    # エラー対応
-    if error_handling is True:
-        tail = ", errors='coerce'"
-    else:
-        tail = ""
-    # コード作成
-    code = f"{new_srs} = pd.to_datetime({old_srs}, format='{format}'{tail})"
+    code = todt_code(
+        df_name,
+        col,
+        fmt=fmt,
+        sep=sep,
+        new_col=new_col,
+        error_handling=error_handling,
+        runtime=runtime,
+    )
     pNc(code, pp=pp)
     return None
 
 
+def todt_apply(
+    df: "DataFrame",
+    cols,
+    *,
+    fmt="ymd",
+    sep="-",
+    errors="coerce",
+    workers=None,
+) -> "DataFrame":
+    """DataFrameのカラムをdatetime型に変換する
+
+    カラムごとに重複のない値だけを変換するので、日付の種類が少なければ行数が多くても速い。
+    複数のカラムはスレッドで並列に変換する。
+
+    Args:
+        df (DataFrame): 変換するDataFrame
+        cols (str | list | dict): カラム名. 新しいカラムに出力するときは{変換前: 変換後}の辞書
+        fmt (str, optional): ymdやymなど日付形式を指定 Defaults to "ymd".
+        sep (str, optional): 変換前のカラムの区切り文字。ない場合は""とする Defaults to "-".
+        errors (str, optional): pd.to_datetimeのerrors Defaults to "coerce".
+        workers (int, optional): 並列に変換するスレッドの数 Defaults to None.
+
+    Returns:
+        DataFrame: 変換後のカラムを持つDataFrame(元のDataFrameは変更しない)
+    """
+    if isinstance(cols, str):
+        cols = [cols]
+    if not isinstance(cols, dict):
+        cols = {col: col for col in cols}
+    format = to_dt_format(fmt, sep)
+    convert = partial(parse_unique_dates, format=format, errors=errors)
+    srs_li = [df[col] for col in cols]
+    if len(srs_li) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(convert, srs_li))
+    else:
+        results = [convert(srs) for srs in srs_li]
+    df = df.copy(deep=False)
+    for new_col, srs in zip(cols.values(), results):
+        df[new_col] = srs
+    return df
+
+
 def psplit(path="", *, multiline=True, pp=True) -> None:
     """絶対パスや相対パスを環境変数を使って書き換える
 
@@ -172,42 +447,40 @@ def psplit(path="", *, multiline=True, pp=True) -> None:
     """
     if path == "":
         # 引数がない場合はクリップボードからコピー
-        path = pyperclip.paste()
-    # 引用符を削除
-    path = path.strip("'").strip('"')
-    # 絶対パスに変換
-    path = ref2abs(path)
-    # 同じ文字を含む環境変数を抽出
-    envs = {k: v for k, v in dict(os.environ).items() if v in path}
-    if len(envs):
-        # 環境変数をパスの文字数で降順にソート
-        envs_sorted = dict(sorted(envs.items(), key=lambda x: -len(x[1])))
-        # 1番目のキーを取得
-        env = next(iter(envs_sorted))
-
-        # 環境変数で置き換える部分は一旦除外
-        obj = path.replace(os.getenv(env), "")
-        # 区切り文字を取得(Windowsはバックスラッシュ)
-        sep_s = fix_sep(path)
-
-        # 環境変数以降のパスをリスト化
-        obj_li = obj.strip(sep_s).split(sep_s)
-        obj_li = [repr(p) for p in obj_li]
-        # 環境変数部分を追加
-        obj_li = [f'os.getenv("{env}")'] + obj_li
-        # 結合して文字列にする
-        obj = (",").join(obj_li)
-        # コードに変換
-        code = shape_code(obj, left="os.path.join(", right=")", multiline=multiline)
+        path = paste_clipboard()
+    code = psplit_code(path, multiline=multiline)
+    if code is not None:
         pNc(code, pp=pp)
-    else:
-        pass
+    return None
+
+
+def psplit_many(paths, *, multiline=True, pp=True) -> None:
+    """複数のパスを環境変数を使って書き換え、まとめて出力する
+
+    環境変数のtrieは1回だけ作る。該当する環境変数がないパスはそのまま文字列として出力する。
+
+    Args:
+        paths (Iterable[str]): 絶対パスや相対パスのリスト
+        multiline (bool, optional): 複数行にするかどうか Defaults to True.
+        pp (bool, optional): クリップボードにコピーするかどうか Defaults to True.
+
+    Returns:
+        _type_: None
+    """
+    trie = env_trie()
+    codes = []
+    for path in paths:
+        code = psplit_code(path, multiline=multiline, trie=trie)
+        codes.append(repr(path.strip("'").strip('"')) if code is None else code)
+    pNc(("\n").join(codes), pp=pp)
     return None
 
 
 def j(code: str, *, min_moji=2, ignore_num=False, ignore_kakko=True, pp=True) -> None:
     """文字列中の日本語を判別してシングルクォーテーションを付ける
 
+    文字列リテラルとコメントの中は変換しない。
+
     Args:
         code (str): 変換前のコード
         min_moji (int, optional): シングルクォーテーションを付ける対象となる最小文字数 Defaults to 2.
@@ -218,41 +491,132 @@ def j(code: str, *, min_moji=2, ignore_num=False, ignore_kakko=True, pp=True) ->
     Returns:
         _type_: None
     """
-    # 日本語とアンダーバーがマッチする位置を取得
-    matched_idxs = search_jp(code, ignore_num=ignore_num, ignore_kakko=ignore_kakko)
-    # idxが連続していたら同じリストに追加
-    group_idxs = grouping_next(matched_idxs)
-    # idxを単語にする
-    word_li = []
-    for idxs in group_idxs:
-        tmp_li = []
-        if len(idxs) < min_moji:
-            # デフォルトは1文字だけの場合スキップ
-            pass
-        else:
-            for idx in idxs:
-                # 1文字ずつ追加
-                tmp_li.append(code[idx])
-            # 文字を繋げて単語にする
-            word = ("").join(tmp_li)
-            # 単語をリストに追加
-            word_li.append(word)
-    # 重複マッチ回避のため、文字数で高順に並べ替え
-    word_li = sorted(word_li, key=lambda x: -len(x))
-    # 辞書を使って文字列を一度に置換
-    replace_di = {}
-    for word in word_li:
-        replace_di[word] = f"'{word}'"
-    code = multi_replace(code, replace_di)
+    # 日本語の連続を1回の走査でクォートする(文字列リテラルとコメントはそのまま)
+    code = quote_jp(
+        code, min_moji=min_moji, ignore_num=ignore_num, ignore_kakko=ignore_kakko
+    )
     pNc(code, pp=pp)
     return None
 
 
+def batch(func, items, /, *, out=None, pp=True, **kwargs) -> None:
+    """lsplit, todt, psplit, jをまとめて実行し、結果を1つにして出力する
+
+    Args:
+        func (str | function): 実行する関数. "lsplit", "todt", "psplit", "j"またはその関数
+        items (Iterable | str): 変換対象のリスト. todtは(df_name, col)のタプルか引数の辞書.
+            ファイルのパスを渡した場合、psplitとtodtは1行ずつ、lsplitとjはファイル全体を変換する.
+            ノートブックの場合はコードセルごとに変換する
+        out (str, optional): 結果を書き込むファイルのパス. 指定しない場合は表示してクリップボードにコピー Defaults to None.
+        pp (bool, optional): クリップボードにコピーするかどうか Defaults to True.
+        **kwargs: 各関数に渡すオプション(multilineなど)
+
+    Returns:
+        _type_: None
+    """
+    name = func if isinstance(func, str) else func.__name__
+    if name not in BATCH_BUILDERS:
+        raise ValueError(f"funcは{tuple(BATCH_BUILDERS)}のいずれかを指定してください: {name}")
+    builder, mode = BATCH_BUILDERS[name]
+    if isinstance(items, str):
+        # ファイルから変換対象を読み込む
+        items = read_batch_items(items, mode)
+    codes = []
+    for item in items:
+        if isinstance(item, dict):
+            code = builder(**{**kwargs, **item})
+        elif isinstance(item, (tuple, list)):
+            code = builder(*item, **kwargs)
+        elif (name == "todt") and isinstance(item, str):
+            # "df_name,col"の形式の行
+            code = builder(*[s.strip() for s in item.split(",")], **kwargs)
+        else:
+            code = builder(item, **kwargs)
+        if code is not None:
+            codes.append(code.strip())
+    code = ("\n" if mode == "lines" else "\n\n").join(codes)
+    if out is None:
+        pNc(code, pp=pp)
+    else:
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(code + "\n")
+        print(f"{len(codes)}件の結果を{out}に出力しました。")
+    return None
+
+
+def iter_sniff(
+    word,
+    /,
+    pattern: str,
+    *,
+    regex=False,
+    environ=None,
+    limit=None,
+    n_neighbors=2,
+    workers=None,
+    executor="thread",
+    index=False,
+    exclude=None,
+    archives=False,
+    stats=None,
+    index_path=None,
+    _notify=True,
+):
+    """指定したファイルから文字列を検索し、マッチしたファイルごとにSniffHitを返すジェネレータ
+
+    ファイルを1つ検索するごとに結果を返す. 途中でcloseすると残りの検索は行わない。
+
+    Args:
+        word (str | list): 検索する文字列. リストで複数指定するとまとめて1回で検索する
+        pattern (str): 検索するファイルパスの正規表現パターン. **も使用可能
+        regex (bool, optional): wordを正規表現として扱う Defaults to False.
+        environ (_type_, optional): ホームパスではなく環境変数でパスを指定するときに使用 Defaults to None.
+        limit (int, optional): 返す検索結果のファイル数 Defaults to None.
+        n_neighbors (int, optional): 検索がマッチした行の前後n行を取得する Defaults to 2.
+        workers (int, optional): 並列に検索するワーカー数. Noneの場合は1ファイルずつ検索 Defaults to None.
+        executor (str, optional): 並列検索に使うプール. "thread"か"process" Defaults to "thread".
+        index (bool, optional): trigramインデックスで候補ファイルを絞り込む. 変更されたファイルは自動で再登録 Defaults to False.
+        index_path (str, optional): index=Trueで使うインデックスファイルのパス. sniff_indexと同じものを指定する Defaults to None.
+        exclude (list, optional): 検索対象から除外するファイルやディレクトリのパターン Defaults to None.
+        archives (bool, optional): .zip, .tar, .tar.gz, .gzの中身も展開しながら検索する.
+            中身はファイル名がパターンの末尾(*.ipynbなど)にマッチするものが対象で、"archive.zip!/path"と表示する Defaults to False.
+        stats (SniffStats, optional): 検索したファイル数やフェーズごとの時間などを集計する.
+            検索が終わるとregister_sniff_hookで登録した関数に渡す Defaults to None.
+
+    Yields:
+        SniffHit: 1ファイル分の検索結果
+    """
+    if stats is None:
+        stats = SniffStats()
+    # 検索文字列をまとめたマッチャーを作成
+    matcher = WordMatcher(word, regex=regex)
+    results = search_files(
+        matcher,
+        pattern,
+        environ=environ,
+        exclude=exclude,
+        index=index,
+        n_neighbors=n_neighbors,
+        workers=workers,
+        executor=executor,
+        stats=stats,
+        archives=archives,
+        index_path=index_path,
+    )
+    try:
+        yield from iter_hits(results, stats, limit=limit)
+    finally:
+        # sniffは表示し終わってから呼び出すので、ここでは呼び出さない
+        if _notify is True:
+            notify_sniff_hooks(stats)
+
+
 def sniff(
-    word: str,
+    word,
     /,
     pattern: str,
     *,
+    regex=False,
     environ=None,
     limit=(DEFAULT_LIMIT := 20),
     n_neighbors=2,
@@ -260,12 +624,20 @@ def sniff(
     decoration=False,
     show_content=True,
     show_filename=True,
-) -> None:
+    workers=None,
+    executor="thread",
+    index=False,
+    exclude=None,
+    archives=False,
+    stats=False,
+    index_path=None,
+):
     """正規表現で指定したファイルから指定した文字列を検索し表示する
 
     Args:
-        word (str): 検索する文字列
+        word (str | list): 検索する文字列. リストで複数指定するとまとめて1回で検索する
         pattern (str): 検索するファイルパスの正規表現パターン. **も使用可能
+        regex (bool, optional): wordを正規表現として扱う Defaults to False.
         environ (_type_, optional): ホームパスではなく環境変数でパスを指定するときに使用 Defaults to None.
         limit (tuple, optional): 検索結果を表示するファイル数 Defaults to (DEFAULT_LIMIT := 20).
         n_neighbors (int, optional): 検索がマッチした行の前後n行を表示する Defaults to 2.
@@ -273,56 +645,92 @@ def sniff(
         decoration (bool, optional): 検索結果の左端に、行番号とマッチした行の目印を表示する Defaults to False.
         show_content (bool, optional): 検索結果を表示する. Falseの場合、ファイル名のみ表示 Defaults to True.
         show_filename (bool, optional): 検索結果にファイル名を表示する Defaults to True.
+        workers (int, optional): 並列に検索するワーカー数. Noneの場合は1ファイルずつ検索 Defaults to None.
+        executor (str, optional): 並列検索に使うプール. "thread"か"process" Defaults to "thread".
+        index (bool, optional): trigramインデックスで候補ファイルを絞り込む. 変更されたファイルは自動で再登録 Defaults to False.
+        index_path (str, optional): index=Trueで使うインデックスファイルのパス. sniff_indexと同じものを指定する Defaults to None.
+        exclude (list, optional): 検索対象から除外するファイルやディレクトリのパターン Defaults to None.
+        archives (bool, optional): .zip, .tar, .tar.gz, .gzの中身も展開しながら検索する.
+            中身はファイル名がパターンの末尾(*.ipynbなど)にマッチするものが対象で、"archive.zip!/path"と表示する Defaults to False.
+        stats (bool, optional): 検索したファイル数やフェーズごとの時間を集計したSniffStatsを返す Defaults to False.
 
     Returns:
-        _type_: _description_
+        SniffStats | None: stats=Trueの場合は集計値
     """
-    # 環境変数で親ディレクトリを取得
-    upper_dir = get_upper_dir(environ)
-    # 引数が絶対パスの場合はuppper_dirが重複するので空白に置き換え
-    pattern = pattern.replace(upper_dir + "/", "")
-    # 親ディレクトリとパターンを結合
-    pattern = os.path.join(upper_dir, pattern)
-    # パスの[]をglob用にescapeする
-    pattern = multi_replace(pattern, {"[": "[[]", "]": "[]]"})
-    # サーチするパスのリストをイテレータで取得
-    paths = glob.iglob(pattern, recursive=True)
-
-    # イテレータをコピー
-    paths, _paths = tee(paths)
-    # 検索対象ファイル数を表示
-    COUNT_LIMIT = 1000
-    file_count = count_itr(_paths, COUNT_LIMIT)
-    if file_count == COUNT_LIMIT:
-        print(f"検索対象ファイル数が{COUNT_LIMIT}を超えています。")
-    else:
-        print(f"検索対象ファイル数は{file_count+1}です。")
+    sniff_stats = SniffStats()
+    hits = iter_sniff(
+        word,
+        pattern,
+        regex=regex,
+        environ=environ,
+        limit=limit,
+        n_neighbors=n_neighbors,
+        workers=workers,
+        executor=executor,
+        index=index,
+        exclude=exclude,
+        archives=archives,
+        stats=sniff_stats,
+        index_path=index_path,
+        _notify=False,
+    )
+    # 検索結果はファイルごとに見つかった時点で出力する
+    n_hits = 0
+    for hit in hits:
+        with sniff_stats.phase("print"):
+            # ファイル名とヒット数、検索結果を出力
+            output = [get_filename(hit, show_filename, count)]
+            output += get_hits(hit, show_content, decoration)
+            print_2dlist(outer_li=[output])
+        n_hits += 1
+    with sniff_stats.phase("print"):
+        if (limit is not None) and (n_hits == limit) and (limit == DEFAULT_LIMIT):
+            print(f"ヒット数が{limit}を超えたので検索を中断しました。")
+
+        # 検索したファイル数を表示
+        print(f"検索対象ファイル数は{sniff_stats.files_searched}です。")
+    notify_sniff_hooks(sniff_stats)
+    if stats is True:
+        return sniff_stats
+    return None
 
-    # 検索結果を辞書に追加
-    result_li = []
-    for path in paths:
-        # 検索結果を取得
-        result_di = get_search_result(path, word, n_neighbors)
-        # 検索結果をリストに追加
-        if result_di != {}:
-            result_li.append(result_di)
-        # ヒット数にlimitを設定
-        if (limit is not None) & (len(result_li) == limit):
-            if limit == DEFAULT_LIMIT:
-                print(f"ヒット数が{limit}を超えたので検索を中断しました。")
-            break
-
-    # 出力内容を作成
-    output_li = []
-    for result_di in result_li:
-        output = []
-        # ファイル名とヒット数を取得
-        output += [get_filename(result_di, show_filename, count)]
-        # 検索結果を追加
-        output += get_hits(result_di, show_content, decoration)
-        # 検索結果をリストに追加
-        output_li.append(output)
-
-    # 出力
-    print_2dlist(outer_li=output_li)
+
+def register_sniff_hook(hook, *, enable=True) -> None:
+    """sniffとiter_sniffの検索が終わるたびに集計値(SniffStats)を渡して呼び出す関数を登録する
+
+    Args:
+        hook (function): SniffStatsを1つ受け取る関数. 例外は警告にして検索は止めない
+        enable (bool, optional): Falseの場合は登録を解除する Defaults to True.
+
+    Returns:
+        _type_: None
+    """
+    if enable is True:
+        if hook not in sniff_hooks:
+            sniff_hooks.append(hook)
+    elif hook in sniff_hooks:
+        sniff_hooks.remove(hook)
+    return None
+
+
+def sniff_index(
+    pattern: str, /, *, environ=None, index_path=None, exclude=None
+) -> None:
+    """sniffで使うtrigramインデックスを作成・更新する
+
+    2回目以降は更新日時とサイズが変わったファイルだけを読み直す。
+
+    Args:
+        pattern (str): インデックスに登録するファイルパスのパターン. **も使用可能
+        environ (_type_, optional): ホームパスではなく環境変数でパスを指定するときに使用 Defaults to None.
+        index_path (str, optional): インデックスファイルのパス Defaults to None.
+        exclude (list, optional): 登録から除外するファイルやディレクトリのパターン Defaults to None.
+
+    Returns:
+        _type_: None
+    """
+    paths = walk_paths(pattern, environ=environ, exclude=exclude)
+    with closing(open_sniff_index(index_path)) as con:
+        n_files, n_updated = refresh_sniff_index(con, paths)
+    print(f"{n_files}ファイル中{n_updated}ファイルをインデックスに登録しました。")
     return None
@@ -1,14 +1,94 @@
+import atexit
+import codecs
+import gzip
+import hashlib
+import html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
+import mmap
 import os
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager, suppress
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 import pathlib
 import platform
-import pyperclip
 import re
+import sqlite3
+import tarfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import warnings
+import zipfile
 
-from pandas import DataFrame
 
 INSTALL_CMD = "pip install git+https://github.com/Taichi-Ibi/ezlite --upgrade"
 
+# sniffのtrigramインデックスの保存先
+SNIFF_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".ezlite", "sniff_index.db")
+# 行の区切り方などを変えたら上げる. 古いインデックスは作り直す
+SNIFF_INDEX_VERSION = 2
+
+# historyで検索する実行履歴の保存先
+HISTORY_DB_PATH = os.path.join(os.path.expanduser("~"), ".ezlite", "history.db")
+
+# df_write_optionのbackground=Trueで出力するスレッドの数
+WRITE_WORKERS = 2
+write_executor = None
+# 出力待ちの数を制限するセマフォと、出力待ちのFuture
+write_slots = threading.BoundedSemaphore(8)
+pending_writes = []
+pending_writes_lock = threading.Lock()
+
+# df_write_optionでto_csvの代わりに出力できる形式
+COLUMNAR_FORMATS = ("parquet", "feather")
+
+# df_write_optionのcache=Trueで出力したファイルのフィンガープリントの保存先
+WRITE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".ezlite", "write_cache.json")
+write_cache_stats = {"hits": 0, "misses": 0}
+write_cache_lock = threading.Lock()
+
+# df_viewerのprofileで頻出値を数える最大行数
+PROFILE_TOP_SAMPLE = 100_000
+# 異なる値の数をHyperLogLogで推定する行数の下限
+PROFILE_HLL_MIN_ROWS = 1 << 16
+# profileの結果を保持するDataFrameの数
+PROFILE_CACHE_SIZE = 16
+profile_cache = OrderedDict()
+# df_viewerのserver=Trueで使い回すサーバー. 表示するDataFrameは呼び出すたびに差し替える
+frame_server = None
+frame_server_lock = threading.Lock()
+
+# msort_treeで整形済みのファイルを記録するキャッシュの保存先
+MSORT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".ezlite", "msort_cache.json")
+# msort_treeでプロセスを使わずに処理するファイル数の上限
+MSORT_SERIAL_MAX = 8
+
+# ノートブックを読み込む単位(文字数)
+NOTEBOOK_CHUNK_SIZE = 1 << 20
+# ノートブックのセルのソースとして保持する最大文字数
+NOTEBOOK_MAX_CHARS = 64 << 20
+
+# mmapした範囲の改行を数えるときに一度にコピーするバイト数
+COUNT_CHUNK_SIZE = 1 << 20
+
+# sniffのarchives=Trueで中身を検索する圧縮ファイル
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".gz")
+
+# sniffで探索しないディレクトリ
+PRUNE_DIRS = {
+    ".git",
+    ".ipynb_checkpoints",
+    ".mypy_cache",
+    ".pytest_cache",
+    ".tox",
+    ".venv",
+    "__pycache__",
+    "node_modules",
+    "venv",
+}
+
 
 TEMPLATE = """
 import glob
@@ -25,13 +105,27 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 """
 
-# DataFrameクラスにデコレータを適用する前の状態を保存する
-pd_to_csv = DataFrame.to_csv
-pd_to_excel = DataFrame.to_excel
+# DataFrameクラスにデコレータを適用する前の状態(df_write_optionの最初の呼び出しで保存する)
+pd_to_csv = None
+pd_to_excel = None
+
+
+def backup_write_option() -> None:
+    # pandasのimportは時間がかかるので、必要になるまで遅らせる
+    global pd_to_csv, pd_to_excel
+    from pandas import DataFrame
+
+    if pd_to_csv is None:
+        pd_to_csv = DataFrame.to_csv
+        pd_to_excel = DataFrame.to_excel
+    return None
 
 
 def df_reset_write_option() -> None:
     # デコレータを削除して元の状態に戻す（バックアップから復元）
+    from pandas import DataFrame
+
+    backup_write_option()
     DataFrame.to_csv = pd_to_csv
     DataFrame.to_excel = pd_to_excel
     return None
@@ -56,6 +150,188 @@ def modify_path(path, dirname=None, prefix="", suffix=""):
     return path
 
 
+def route_csv_write(
+    func, path_or_buf, args, kwargs, format=None, compression=None, chunksize=None
+):
+    """to_csvの書き込み方法を出力形式に合わせて切り替える
+
+    Returns:
+        tuple: (書き込む関数, 出力先, 位置引数, キーワード引数)
+    """
+    if format in (None, "csv"):
+        kwargs = dict(kwargs)
+        if compression is not None:
+            kwargs.setdefault("compression", compression)
+        if chunksize is not None:
+            # pandasはchunksize行ずつ文字列にして書き込む
+            kwargs.setdefault("chunksize", chunksize)
+        return func, path_or_buf, args, kwargs
+    if format not in COLUMNAR_FORMATS:
+        raise ValueError(f"formatは{COLUMNAR_FORMATS}のいずれかを指定してください: {format}")
+    if not isinstance(path_or_buf, (str, os.PathLike)):
+        # テキストのバッファーにはparquetなどを書き込めないのでcsvのまま出力
+        print(f"バッファーには{format}で出力できないため、csvで出力します。")
+        return func, path_or_buf, args, kwargs
+    # indexとcolumns以外のcsv用の引数(sepやheaderなど)は使えないので警告する
+    kwargs = dict(kwargs)
+    index = kwargs.pop("index", True)
+    columns = kwargs.pop("columns", None)
+    ignored = list(kwargs)
+    if args:
+        ignored.insert(0, f"位置引数{len(args)}個")
+    if ignored:
+        warnings.warn(f"{format}で出力するため、csv用の引数を無視しました: {', '.join(ignored)}")
+    # 拡張子を出力形式に合わせる
+    path = os.path.splitext(os.fspath(path_or_buf))[0] + "." + format
+    write = partial(
+        write_columnar,
+        format=format,
+        compression=compression,
+        index=index,
+        columns=columns,
+    )
+    return write, path, (), {}
+
+
+def write_columnar(df, path, format, compression=None, index=True, columns=None):
+    """DataFrameをparquetかfeatherで出力する. columnsを指定した場合はそのカラムだけを出力する"""
+    from pandas import RangeIndex
+
+    if columns is not None:
+        df = df[list(columns)]
+    if format == "parquet":
+        df.to_parquet(path, compression=compression or "snappy", index=index)
+    elif format == "feather":
+        # featherは既定のインデックスしか保存できないのでカラムに戻す
+        if index is True and not df.index.equals(RangeIndex(len(df))):
+            df = df.reset_index()
+        else:
+            df = df.reset_index(drop=True)
+        df.to_feather(path, compression=compression)
+    return None
+
+
+def cached_write(write, name):
+    """出力するDataFrameと引数が前回と同じで、ファイルも変更されていなければ出力しない関数を返す"""
+
+    def _write(df, path_or_buf, *args, **kwargs):
+        if not isinstance(path_or_buf, (str, os.PathLike)):
+            return write(df, path_or_buf, *args, **kwargs)
+        path = os.path.abspath(path_or_buf)
+        options = (name, getattr(write, "keywords", None), args, sorted(kwargs.items()))
+        fingerprint = frame_fingerprint(df, extra=options)
+        with write_cache_lock:
+            entry = None
+            if fingerprint is not None:
+                entry = write_cache_entry(path, fingerprint)
+            is_hit = (entry is not None) and (load_write_cache().get(path) == entry)
+            write_cache_stats["hits" if is_hit else "misses"] += 1
+        if is_hit:
+            print(f"内容が変わっていないためファイル出力をスキップしました: {path}")
+            return None
+        result = write(df, path_or_buf, *args, **kwargs)
+        if fingerprint is not None:
+            with write_cache_lock:
+                write_cache = load_write_cache()
+                write_cache[path] = write_cache_entry(path, fingerprint)
+                try:
+                    save_write_cache(write_cache)
+                except OSError as e:
+                    # ファイルは出力済みなので、キャッシュを保存できなくても失敗にしない
+                    warnings.warn(f"出力のキャッシュを保存できませんでした: {e}")
+        return result
+
+    return _write
+
+
+def frame_fingerprint(df, extra=()):
+    """DataFrameの形、カラム、型と全行のハッシュ、extraからフィンガープリントを作る
+
+    一部の行だけを書き換えた場合も値が変わる. ハッシュできない値を含む場合はNoneを返す。
+    """
+    from pandas.util import hash_pandas_object
+
+    h = hashlib.blake2b(digest_size=16)
+    meta = (df.shape, [str(c) for c in df.columns], [str(t) for t in df.dtypes], extra)
+    h.update(repr(meta).encode("utf-8"))
+    try:
+        h.update(hash_pandas_object(df, index=True).to_numpy().tobytes())
+    except TypeError:
+        return None
+    return h.hexdigest()
+
+
+def write_cache_entry(path, fingerprint):
+    """フィンガープリントとファイルの更新日時・サイズ(外部での変更の検知用)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return {"fingerprint": fingerprint, "mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def load_write_cache():
+    try:
+        with open(WRITE_CACHE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_write_cache(write_cache):
+    # 別のプロセスと同時に保存しても壊れないように、プロセスごとの一時ファイルから置き換える
+    os.makedirs(os.path.dirname(WRITE_CACHE_PATH), exist_ok=True)
+    write_atomic(WRITE_CACHE_PATH, json.dumps(write_cache))
+    return None
+
+
+def set_write_queue(max_pending):
+    """バックグラウンドで出力待ちにできる数を設定する"""
+    global write_slots
+    write_slots = threading.BoundedSemaphore(max_pending)
+    return None
+
+
+def submit_write(func, df, *args, **kwargs):
+    """DataFrameの出力を別スレッドに渡してFutureを返す. 出力待ちが上限の場合は空くまで待つ"""
+    global write_executor
+    if write_executor is None:
+        write_executor = ThreadPoolExecutor(
+            max_workers=WRITE_WORKERS, thread_name_prefix="ezlite-write"
+        )
+    slots = write_slots
+    slots.acquire()
+    try:
+        future = write_executor.submit(func, df, *args, **kwargs)
+    except BaseException:
+        slots.release()
+        raise
+    with pending_writes_lock:
+        pending_writes.append(future)
+
+    def _done(future):
+        slots.release()
+        error = future.exception()
+        if error is not None:
+            print(f"ファイル出力に失敗しました: {args[0]} ({error!r})")
+
+    future.add_done_callback(_done)
+    return future
+
+
+def wait_writes():
+    """出力待ちのFutureがすべて終わるまで待ち、失敗した例外のリストを返す"""
+    with pending_writes_lock:
+        futures = pending_writes[:]
+        pending_writes.clear()
+    errors = []
+    for future in futures:
+        error = future.exception()
+        if error is not None:
+            errors.append(error)
+    return errors
+
+
 def multi_replace(string, mapping):
     """
     文字列中の複数の文字列やパターンを同時に置換します。
@@ -65,10 +341,12 @@ def multi_replace(string, mapping):
     mapping: 検索対象をキー、その置換文字列を値とする辞書。
         キーとしてstrまたはreパターンオブジェクトを指定できる。
         キーがreパターンオブジェクトの場合は、置換文字列中でグループ参照 '\\1', '\\2',... が有効。
+        同じ位置にマッチする文字列のキーが複数ある場合は長いものを優先する。
     """
-    catch_all_pattern = "|".join(map(to_pattern, mapping))
-    replacer = make_replacer(mapping)
-    return re.subn(catch_all_pattern, replacer, string)[0]
+    if not mapping:
+        return string
+    replacer = get_replacer(mapping)
+    return replacer(string)
 
 
 # workaround for Python which does't have typing module
@@ -84,83 +362,216 @@ def to_pattern(key):
         raise Exception("Failed to replace!")
 
 
-def make_replacer(mapping):
-    def _replacer(match):
-        src = match.group(0)
+class Replacer:
+    """multi_replaceのmappingを1回だけコンパイルした置換器
+
+    文字列のキーは長いものを優先してグループなしの1つの選択にまとめ、マッチした文字列から
+    置換文字列を辞書で引く。パターンのキーだけを外側のグループで囲み、マッチしたグループ番号
+    (lastindex)からグループ番号をずらしたテンプレートを引く。
+    """
+
+    def __init__(self, mapping):
+        # グループで囲むと正規表現エンジンの文字列の選択の高速化が効かなくなる
+        self.literals = {k: v for k, v in mapping.items() if isinstance(k, str)}
+        parts = []
+        if self.literals:
+            keys = sorted(self.literals, key=len, reverse=True)
+            parts.append("(?:" + "|".join(map(re.escape, keys)) + ")")
+        # 外側のグループ番号 -> グループ番号をずらしたテンプレート
+        self.dispatch = {}
+        group = 1
         for key, val in mapping.items():
-            if src == key:
-                return val
-            elif isinstance(key, _PatternType) and re.match(
-                "(?:" + key.pattern + r")\Z", src
-            ):  # workaround for Python which doesn't have re.fullmatch
-                return key.sub(val, src)
-
-    return _replacer
-
-
-def grouping_next(idx_li):
-    group_idxs, tmp_li = [], []
-    for i, l in enumerate(idx_li):
-        if i == 0:
-            # 先頭のidxを格納
-            tmp_li.append(l)
+            if isinstance(key, str):
+                continue
+            parts.append(to_pattern(key))
+            self.dispatch[group] = shift_template(val, group)
+            group += 1 + key.groups
+        self.pattern = re.compile("|".join(parts))
+
+    def __call__(self, string):
+        return self.pattern.sub(self._replace, string)
+
+    def _replace(self, match):
+        if match.lastindex is None:
+            # グループがマッチしていなければ文字列のキー
+            return self.literals[match.group(0)]
+        return match.expand(self.dispatch[match.lastindex])
+
+
+@lru_cache(maxsize=128)
+def _compile_replacer(items):
+    return Replacer(dict(items))
+
+
+def get_replacer(mapping):
+    """mappingに対応するReplacerを返す. 同じmappingは前回コンパイルしたものを使う"""
+    try:
+        return _compile_replacer(tuple(mapping.items()))
+    except TypeError:
+        # ハッシュできない値を含む場合はキャッシュしない
+        return Replacer(mapping)
+
+
+def shift_template(template, offset):
+    """パターンの置換文字列のグループ参照を、まとめた正規表現でのグループ番号に書き換える"""
+
+    def _shift(m):
+        number = m.group(1) or m.group(2)
+        if number is None:
+            # グループ参照以外のエスケープはそのまま
+            return m.group(0)
+        return f"\\g<{int(number) + offset}>"
+
+    ptn = r"\\(?:([1-9][0-9]?)|g<([0-9]+)>|.)"
+    return re.sub(ptn, _shift, template, flags=re.DOTALL)
+
+
+class WordMatcher:
+    """sniffの検索文字列をまとめて、ファイルを1回走査するだけで検索できるようにする
+
+    words: 検索する文字列、または文字列のリスト
+    regex: Trueの場合は各文字列を正規表現として扱う
+    """
+
+    def __init__(self, words, regex=False):
+        if isinstance(words, str):
+            words = [words]
+        self.words = list(words)
+        if regex is True:
+            self.patterns = [re.compile(w) for w in self.words]
+            keys = self.patterns
         else:
-            # 先頭以外
-            if idx_li[i] - idx_li[i - 1] == 1:
-                # idxが連続している場合は一時リストに追加
-                tmp_li.append(l)
-            else:
-                # idxが連続していない場合は一時リストをインデックスグループに追加し、一時リストに追加
-                group_idxs.append(tmp_li)
-                tmp_li = []
-                tmp_li.append(l)
-            if i + 1 == len(idx_li):
-                # 末尾の場合は一時リストを単語idxリストに追加
-                group_idxs.append(tmp_li)
-    return group_idxs
-
-
-def search_jp(code, ignore_num, ignore_kakko):
-    # 日本語とアンダーバーの正規表現パターン
-    ptn = r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f|_|-"
+            self.patterns = None
+            # 長い文字列を優先してマッチさせる
+            keys = sorted(self.words, key=len, reverse=True)
+        self.pattern = None
+        # グループを含む正規表現はまとめると\1などの参照がずれるので、1つずつ検索する
+        if (self.patterns is None) or all(p.groups == 0 for p in self.patterns):
+            try:
+                self.pattern = re.compile("|".join(map(to_pattern, keys)))
+            except re.error:
+                # (?i)などのフラグを先頭に置いた正規表現もまとめられない
+                pass
+        self.bytes_pattern = to_bytes_pattern(keys)
+        # 文字列1つの場合はinとmmap.findで検索する
+        self.needle = None
+        if (regex is False) and (len(self.words) == 1):
+            self.needle = self.words[0].encode("utf-8")
+
+    def search(self, line):
+        if self.needle is not None:
+            return self.words[0] in line
+        if self.pattern is None:
+            return any(p.search(line) for p in self.patterns)
+        return self.pattern.search(line) is not None
+
+    def matched_words(self, line):
+        """行に含まれる検索文字列のリストを返す"""
+        if self.patterns is None:
+            return [w for w in self.words if w in line]
+        return [w for w, p in zip(self.words, self.patterns) if p.search(line)]
+
+    def find(self, mm, pos):
+        """バイト列のpos以降で最初にマッチした位置を返す. ない場合は-1"""
+        if self.needle is not None:
+            return mm.find(self.needle, pos)
+        m = self.bytes_pattern.search(mm, pos)
+        return -1 if m is None else m.start()
+
+
+def to_matcher(word):
+    if isinstance(word, WordMatcher):
+        return word
+    return WordMatcher(word)
+
+
+def to_bytes_pattern(keys):
+    """UTF-8のバイト列をそのまま検索する正規表現に変換する
+
+    正規表現はNoneを返し、デコードした行ごとに検索する。
+    バイト列の正規表現では\\wや(?i)がASCIIにしかマッチせず、改行をまたいでマッチすることもあるため。
+    """
+    byte_keys = []
+    for key in keys:
+        if not isinstance(key, str):
+            return None
+        byte_keys.append(re.escape(key.encode("utf-8")))
+    return re.compile(b"|".join(byte_keys))
+
+
+# 日本語の文字の範囲
+JP_RANGES = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f"
+JP_CHAR = re.compile(f"[{JP_RANGES}]")
+# 文字列リテラルとコメント
+SKIP_PATTERN = (
+    r"'''[\s\S]*?'''"
+    r'|"""[\s\S]*?"""'
+    r"|'(?:[^'\\\n]|\\.)*'"
+    r'|"(?:[^"\\\n]|\\.)*"'
+    r"|#[^\n]*"
+)
+
+
+def quote_jp(code, min_moji=2, ignore_num=False, ignore_kakko=True):
+    """日本語を含む連続した文字をシングルクォーテーションで囲む
+
+    文字列リテラルとコメントは読み飛ばし、コード全体を1回の走査で変換する。
+    """
+    scanner = jp_scanner(ignore_num, ignore_kakko)
+
+    def _quote(m):
+        word = m.group("word")
+        # 文字列リテラルやコメント、短い単語、日本語を含まない単語はそのまま
+        if (word is None) or (len(word) < min_moji) or (not JP_CHAR.search(word)):
+            return m.group(0)
+        return f"'{word}'"
+
+    return scanner.sub(_quote, code)
+
+
+@lru_cache(maxsize=None)
+def jp_scanner(ignore_num, ignore_kakko):
+    # 日本語とアンダーバー(オプションで数字と丸括弧)の連続
+    chars = JP_RANGES + "_"
     if ignore_num is False:
-        ptn += r"|\d"
+        chars += r"\d"
     if ignore_kakko is False:
-        ptn += r"|\(|\)"
-    ptn += r"]"
-    # 正規表現で検索（マッチオブジェクトが返ってくる）
-    matches = re.finditer(ptn, code)
-    # マッチした位置をリストに格納
-    matched_idxs = []
-    for m in matches:
-        idx = m.start()
-        matched_idxs.append(idx)
-    return matched_idxs
-
-
-def get_hits(result_di, show_content, decoration):
+        chars += r"()"
+    return re.compile(f"(?P<skip>{SKIP_PATTERN})|(?P<word>[{chars}]+)")
+
+
+def get_hits(hit, show_content, decoration):
     if show_content is True:
-        idxs = result_di.get("index_added")
         content = []
-        for itr, idx in enumerate(idxs):
-            line = result_di.get("lines")[idx]
-            # 行番号とヒット行に*を表示
-            if decoration is True:
-                # ヒットマーク
-                if idx in result_di.get("indexs"):
-                    head = "* "
-                else:
-                    head = "  "
-                # 行番号
-                line = head + "  ".join(
-                    [str(idx).rjust(result_di.get("max_digits")), line]
-                )
-            # 1行目ではなくて、行番号が2以上離れている場合は改行
-            idxs_diff = idxs[itr] - idxs[itr - 1]
-            if (itr != 0) & (idxs_diff != 1):
+        # マッチした行番号とセルの開始行は昇順なので先頭から順番に照合する
+        matched = iter(hit.indexs)
+        next_match = next(matched, None)
+        cell_starts = hit.cell_starts or []
+        cell_no = 0
+        for i_block, (start, lines) in enumerate(hit.blocks):
+            # 表示する範囲が離れている場合は改行
+            if i_block != 0:
                 content.append("")
-            # 行を出力リストに追加
-            content.append(line)
+            for idx, line in enumerate(lines, start):
+                # ノートブックの場合はセルの先頭と表示の先頭にセル番号を表示
+                is_cell_head = False
+                while (cell_no < len(cell_starts)) and (cell_starts[cell_no] <= idx):
+                    is_cell_head = cell_starts[cell_no] == idx
+                    cell_no += 1
+                if (decoration is True) & bool(cell_starts):
+                    if (idx == start) | is_cell_head:
+                        content.append(f"[cell {cell_no}]")
+                # ヒットマーク
+                is_matched = idx == next_match
+                if is_matched:
+                    next_match = next(matched, None)
+                # 行番号とヒット行に*を表示
+                if decoration is True:
+                    head = "* " if is_matched else "  "
+                    # 行番号
+                    line = head + "  ".join([str(idx).rjust(hit.max_digits), line])
+                # 行を出力リストに追加
+                content.append(line)
         # ファイルごとに改行
         content.append("")
         return content
@@ -168,45 +579,750 @@ def get_hits(result_di, show_content, decoration):
         return []
 
 
-def get_filename(result, show_filename, count):
+def get_filename(hit, show_filename, count):
     if show_filename is True:
         # ファイル名を表示
-        path = "- " + result.get("path")
+        path = "- " + hit.path
         if count is True:
             # マッチ数を表示
-            path += " " + str(result.get("count"))
+            path += " " + str(hit.count)
+            # 複数の文字列で検索した場合は文字列ごとのマッチ数も表示
+            counts = hit.counts
+            if counts:
+                path += " (" + ", ".join(f"{w}: {n}" for w, n in counts.items()) + ")"
         return path
     else:
         return ""
 
 
-def get_search_result(path, word, n_neighbors):
-    # 行ごとにリスト化
-    lines = get_lines(path)
-    # マッチしたindexを取得
-    indexs = get_matched_idxs(lines, word=word)
+class SniffHit:
+    """sniffで1ファイル分の検索結果
+
+    表示する範囲の行だけを保持するので、マッチ数が多いファイルでもメモリは表示分で済む。
+
+    path: ファイルパス
+    indexs: マッチした行番号のリスト(昇順)
+    count: マッチした行数
+    blocks: 前後の行を含めて連続する範囲ごとの(開始行番号, 行のリスト)のリスト
+    max_digits: 行番号の最大桁数
+    counts: 複数の文字列で検索した場合の文字列ごとのマッチ行数
+    cell_starts: ノートブックの場合の各セルの開始行
+    """
+
+    __slots__ = (
+        "path",
+        "indexs",
+        "count",
+        "blocks",
+        "max_digits",
+        "counts",
+        "cell_starts",
+    )
+
+    def __init__(
+        self, path, indexs, count, blocks, max_digits, counts=None, cell_starts=None
+    ):
+        self.path = path
+        self.indexs = indexs
+        self.count = count
+        self.blocks = blocks
+        self.max_digits = max_digits
+        self.counts = counts
+        self.cell_starts = cell_starts
+
+    def __repr__(self):
+        return f"SniffHit(path={self.path!r}, count={self.count})"
+
+    def iter_lines(self):
+        """表示する行の(行番号, 行)を順番に返す"""
+        for start, lines in self.blocks:
+            yield from enumerate(lines, start)
+
+
+class SniffStats:
+    """sniffの検索で集計する値
+
+    timesはフェーズ(walk, index, parse, match, print)ごとの経過時間の合計(秒)。
+    workersを指定した場合、parseとmatchはワーカーごとの時間を足したものになる。
+    """
+
+    PHASES = ("walk", "index", "parse", "match", "print")
+
+    def __init__(self):
+        # パターンにマッチしたファイル数
+        self.files_walked = 0
+        # インデックスで除外したファイルやバイナリファイルなど、検索しなかったファイル数
+        self.files_skipped = 0
+        self.bytes_read = 0
+        self.notebooks_parsed = 0
+        self.parse_failures = 0
+        # 読み込みに失敗したファイルと例外のメッセージ
+        self.failures = []
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+
+    @property
+    def files_searched(self):
+        return self.files_walked - self.files_skipped
+
+    def __repr__(self):
+        times = ", ".join(f"{k}={v:.3f}s" for k, v in self.times.items())
+        return (
+            f"SniffStats(files_walked={self.files_walked}, "
+            f"files_skipped={self.files_skipped}, bytes_read={self.bytes_read}, "
+            f"notebooks_parsed={self.notebooks_parsed}, "
+            f"parse_failures={self.parse_failures}, times=({times}))"
+        )
+
+    @contextmanager
+    def phase(self, name):
+        """with文の中の経過時間をフェーズに加算する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def add_failure(self, path, error):
+        self.parse_failures += 1
+        self.failures.append((path, f"{type(error).__name__}: {error}"))
+        return None
+
+    def merge(self, other):
+        """ワーカーで集計した1ファイル分の値を加算する"""
+        self.files_walked += other.files_walked
+        self.files_skipped += other.files_skipped
+        self.bytes_read += other.bytes_read
+        self.notebooks_parsed += other.notebooks_parsed
+        self.parse_failures += other.parse_failures
+        self.failures.extend(other.failures)
+        for name, seconds in other.times.items():
+            self.times[name] += seconds
+        return None
+
+    def as_dict(self):
+        return {
+            "files_walked": self.files_walked,
+            "files_searched": self.files_searched,
+            "files_skipped": self.files_skipped,
+            "bytes_read": self.bytes_read,
+            "notebooks_parsed": self.notebooks_parsed,
+            "parse_failures": self.parse_failures,
+            "failures": list(self.failures),
+            "times": dict(self.times),
+        }
+
+
+# sniffの検索が終わるたびにSniffStatsを渡して呼び出す関数
+sniff_hooks = []
+
+
+def notify_sniff_hooks(stats):
+    for hook in list(sniff_hooks):
+        try:
+            hook(stats)
+        except Exception as e:
+            # 集計用の関数の失敗で検索を止めない
+            warnings.warn(f"sniffのhookでエラーが発生しました: {type(e).__name__}: {e}")
+    return None
+
+
+def search_file(path, word, n_neighbors, member_filter=None):
+    """1ファイルを検索して(検索結果のリスト, そのファイルの集計値)を返す. ワーカーで実行する
+
+    member_filterを渡した場合、圧縮ファイルはファイル名がmember_filterにマッチする中身を検索する。
+    """
+    stats = SniffStats()
+    if (member_filter is not None) and is_archive(path):
+        hits = search_archive(path, word, n_neighbors, member_filter, stats=stats)
+    else:
+        hit = get_search_result(path, word, n_neighbors, stats=stats)
+        hits = [] if hit is None else [hit]
+    return hits, stats
+
+
+def get_search_result(path, word, n_neighbors, stats=None):
+    matcher = to_matcher(word)
+    if stats is None:
+        stats = SniffStats()
+    cell_starts = None
+    if path.endswith("ipynb"):
+        # 行ごとにリスト化(ノートブックはセルの開始行も取得)
+        with stats.phase("parse"):
+            lines, cell_starts = parse_ipynb(path, with_cells=True, stats=stats)
+        # マッチしたindexを取得
+        with stats.phase("match"):
+            indexs = get_matched_idxs(lines, word=matcher)
+    elif matcher.bytes_pattern is None:
+        # 正規表現は行ごとにリスト化して検索
+        with stats.phase("parse"):
+            lines = read_text_lines(path, stats=stats)
+        with stats.phase("match"):
+            indexs = get_matched_idxs(lines, word=matcher)
+    else:
+        # テキストはmmapで検索し、マッチした行と前後の行だけを取得
+        with stats.phase("match"):
+            indexs, lines = search_text(path, matcher, n_neighbors, stats=stats)
+    return make_hit(path, matcher, indexs, lines, n_neighbors, cell_starts)
+
+
+def make_hit(path, matcher, indexs, lines, n_neighbors, cell_starts=None):
+    """マッチした行番号と行(リストか{行番号: 行}の辞書)からSniffHitを作る"""
     if indexs == []:
         # マッチした行がない場合はpass
-        return {}
+        return None
     else:
         # マッチした行数を取得
         count = len(indexs)
-        # n_neighborsの数だけ前後の行を取得する
-        _indexs = collect_neighbors(indexs, n_neighbors=n_neighbors)
+        # 複数の文字列で検索した場合は文字列ごとのマッチ数を取得
+        counts = None
+        if len(matcher.words) > 1:
+            counts = dict.fromkeys(matcher.words, 0)
+            for idx in indexs:
+                for w in matcher.matched_words(lines[idx]):
+                    counts[w] += 1
         # マッチした行の最大桁数を取得
-        max_digits = len(str(max(_indexs)))
-        # ファイルの行数からはみ出たものは除外
-        _indexs = [i for i in _indexs if i in range(0, len(lines))]
-        # dictに格納
-        result_di = {
-            "path": path,
-            "lines": lines,
-            "indexs": indexs,
-            "count": count,
-            "index_added": _indexs,
-            "max_digits": max_digits,
-        }
-        return result_di
+        max_digits = len(str(indexs[-1] + n_neighbors))
+        # n_neighborsの数だけ前後の行を含む範囲をまとめて、その範囲の行だけを残す
+        if isinstance(lines, list):
+            ranges = merge_neighbors(indexs, n_neighbors, n_lines=len(lines))
+            blocks = [(start, lines[start:end]) for start, end in ranges]
+        else:
+            # mmapで取得した行はファイル末尾を超えた分がないので、ある行だけを残す
+            ranges = merge_neighbors(indexs, n_neighbors)
+            blocks = [
+                (start, [lines[i] for i in range(start, end) if i in lines])
+                for start, end in ranges
+            ]
+        return SniffHit(
+            path=path,
+            indexs=indexs,
+            count=count,
+            blocks=blocks,
+            max_digits=max_digits,
+            counts=counts,
+            cell_starts=cell_starts,
+        )
+
+
+def search_text(path, word, n_neighbors, stats=None):
+    """テキストファイルをmmapしてバイト列のまま検索する
+
+    ファイル全体を文字列にはせず、マッチした行と前後n_neighbors行だけをデコードする。
+
+    Returns:
+        tuple: (マッチした行番号のリスト, {行番号: 行の文字列})
+    """
+    matcher = to_matcher(word)
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return [], {}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # バイナリファイルは対象外
+                if b"\0" in mm[:8192]:
+                    if stats is not None:
+                        stats.files_skipped += 1
+                    return [], {}
+                if stats is not None:
+                    stats.bytes_read += size
+                return search_mmap(mm, matcher, n_neighbors)
+    except (OSError, ValueError) as e:
+        if stats is not None:
+            stats.add_failure(path, e)
+        return [], {}
+
+
+def search_mmap(mm, matcher, n_neighbors):
+    # マッチした行の行番号と先頭位置を取得
+    matched = []
+    line_no, counted = 0, 0
+    pos = matcher.find(mm, 0)
+    while pos != -1:
+        line_start = mm.rfind(b"\n", counted, pos) + 1 or counted
+        line_no += count_newlines(mm, counted, line_start)
+        counted = line_start
+        matched.append((line_no, line_start))
+        line_end = mm.find(b"\n", pos)
+        if line_end == -1:
+            break
+        # 同じ行の2つ目以降のマッチは数えない
+        pos = matcher.find(mm, line_end + 1)
+
+    # マッチした行と前後の行だけをデコード
+    lines = {}
+    size = len(mm)
+    for line_no, line_start in matched:
+        start = line_start
+        for k in range(1, n_neighbors + 1):
+            # 前のマッチでデコード済みの行まで戻ったら終了
+            if (start == 0) or (line_no - k in lines):
+                break
+            prev = mm.rfind(b"\n", 0, start - 1) + 1
+            lines[line_no - k] = decode_line(mm[prev : start - 1])
+            start = prev
+        start = line_start
+        for k in range(0, n_neighbors + 1):
+            end = mm.find(b"\n", start)
+            if end == -1:
+                end = size
+            if line_no + k not in lines:
+                lines[line_no + k] = decode_line(mm[start:end])
+            if end == size:
+                break
+            start = end + 1
+    return [line_no for line_no, _ in matched], lines
+
+
+def count_newlines(mm, start, end):
+    """mmapのstartからendまでの改行の数をチャンクごとに数える"""
+    n = 0
+    for i in range(start, end, COUNT_CHUNK_SIZE):
+        n += mm[i : min(i + COUNT_CHUNK_SIZE, end)].count(b"\n")
+    return n
+
+
+def decode_line(line):
+    return line.decode("utf-8", errors="replace").rstrip("\r")
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def search_archive(path, word, n_neighbors, member_filter, stats=None):
+    """圧縮ファイルを展開しながら中身を1つずつ検索し、検索結果のリストを返す
+
+    一時ファイルには書き出さない. 中身のパスは"archive.zip!/path/in/archive"の形式にする。
+    圧縮ファイル自体がmember_filterにマッチする場合はすべての中身を検索する。
+    """
+    matcher = to_matcher(word)
+    if stats is None:
+        stats = SniffStats()
+    if member_filter.fullmatch(os.path.basename(path)):
+        keep = None
+    else:
+        keep = lambda name: member_filter.fullmatch(name.rsplit("/", 1)[-1])
+    hits = []
+    try:
+        stats.bytes_read += os.path.getsize(path)
+        for name, f in iter_archive_members(path, keep):
+            member_path = f"{path}!/{name}"
+            try:
+                hit = search_member(member_path, f, matcher, n_neighbors, stats)
+            except ValueError as e:
+                # 壊れたノートブックなど中身ごとの失敗は記録して次の中身へ進む
+                stats.add_failure(member_path, e)
+                continue
+            if hit is not None:
+                hits.append(hit)
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+        stats.add_failure(path, e)
+    return hits
+
+
+def iter_archive_members(path, keep=None):
+    """圧縮ファイルの中身の(パス, バイナリのファイルオブジェクト)を順番に返す
+
+    tarはストリームとして先頭から読むので、対象外の中身は展開せずに読み飛ばす。
+    """
+    lower = path.lower()
+    if lower.endswith(".zip"):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or ((keep is not None) and not keep(info.filename)):
+                    continue
+                with zf.open(info) as f:
+                    yield info.filename, f
+    elif lower.endswith((".tar", ".tar.gz", ".tgz")):
+        with tarfile.open(path, mode="r|*") as tf:
+            for member in tf:
+                if (not member.isfile()) or ((keep is not None) and not keep(member.name)):
+                    continue
+                with tf.extractfile(member) as f:
+                    yield member.name, f
+    else:
+        # .gzは1ファイルだけなので、拡張子を除いた名前を中身のパスにする
+        name = os.path.basename(path)[:-3]
+        if (keep is None) or keep(name):
+            with gzip.open(path) as f:
+                yield name, f
+
+
+def search_member(member_path, f, matcher, n_neighbors, stats):
+    """圧縮ファイルの中身を1つ検索する. ノートブックはセルのソースだけを読む"""
+    if member_path.endswith("ipynb"):
+        with stats.phase("parse"):
+            # tarのストリームはseekできずTextIOWrapperが使えないので、codecsでデコードする
+            lines, cell_starts = read_notebook_lines(codecs.getreader("utf-8")(f))
+            stats.notebooks_parsed += 1
+        with stats.phase("match"):
+            indexs = get_matched_idxs(lines, word=matcher)
+        return make_hit(member_path, matcher, indexs, lines, n_neighbors, cell_starts)
+    with stats.phase("match"):
+        result = search_stream(f, matcher, n_neighbors)
+    if result is None:
+        # バイナリは対象外
+        return None
+    indexs, lines = result
+    return make_hit(member_path, matcher, indexs, lines, n_neighbors)
+
+
+def search_stream(f, matcher, n_neighbors):
+    """バイナリのファイルオブジェクトを1行ずつ検索する. バイナリファイルの場合はNone
+
+    直前の行はn_neighbors行分だけ保持し、マッチした行と前後の行だけをデコードする。
+
+    Returns:
+        tuple: (マッチした行番号のリスト, {行番号: 行の文字列})
+    """
+    head = f.peek(8192)[:8192] if hasattr(f, "peek") else b""
+    if b"\0" in head:
+        return None
+    use_bytes = matcher.bytes_pattern is not None
+    before = deque(maxlen=n_neighbors)
+    indexs, lines = [], {}
+    after = 0
+    for line_no, raw in enumerate(f):
+        raw = raw.rstrip(b"\n")
+        if use_bytes:
+            matched = matcher.find(raw, 0) != -1
+        else:
+            matched = matcher.search(decode_line(raw))
+        if matched:
+            indexs.append(line_no)
+            # 保持しておいた直前の行をデコード
+            for i, prev in before:
+                lines[i] = decode_line(prev)
+            before.clear()
+            lines[line_no] = decode_line(raw)
+            after = n_neighbors
+        elif after > 0:
+            lines[line_no] = decode_line(raw)
+            after -= 1
+        else:
+            before.append((line_no, raw))
+    return indexs, lines
+
+
+def search_files(
+    matcher,
+    pattern,
+    *,
+    environ=None,
+    exclude=None,
+    index=False,
+    n_neighbors=2,
+    workers=None,
+    executor="thread",
+    stats=None,
+    archives=False,
+    index_path=None,
+):
+    """パターンにマッチするファイルを検索して、ファイルごとの(検索結果のリスト, 集計値)を返すイテレータ
+
+    マッチしなかったファイルの検索結果は空のリストになる。
+    ファイルの探索とインデックスの集計値は、statsを渡した場合にそこへ直接加算する。
+    archivesがTrueの場合は、圧縮ファイルの中身のうちファイル名がパターンの末尾にマッチするものも検索する。
+    """
+    if stats is None:
+        stats = SniffStats()
+    member_filter = None
+    if archives is True:
+        # 中身はパターンの末尾(ファイル名の部分)で絞り込む
+        name_pattern = pattern.replace("\\", "/").rsplit("/", 1)[-1]
+        member_filter = re.compile(glob_to_regex([name_pattern]))
+    # サーチするパスをイテレータで取得(重いディレクトリは探索しない)
+    paths = walk_paths(pattern, environ=environ, exclude=exclude, archives=archives)
+    paths = timed_iter(paths, stats, "walk")
+
+    # インデックスを更新して、検索文字列を含みうるファイルだけに絞り込む
+    if index is True:
+        paths = list(paths)
+        # 圧縮ファイルはインデックスに登録せず、常に検索する
+        archive_paths = set()
+        if archives is True:
+            archive_paths = {p for p in paths if is_archive(p)}
+        with stats.phase("index"):
+            with closing(open_sniff_index(index_path)) as con:
+                refresh_sniff_index(con, [p for p in paths if p not in archive_paths])
+                # 正規表現の場合は絞り込めない
+                candidates = None
+                if matcher.patterns is None:
+                    candidates = query_sniff_index(con, matcher.words)
+        if candidates is not None:
+            n_paths = len(paths)
+            paths = [p for p in paths if (p in candidates) or (p in archive_paths)]
+            stats.files_skipped += n_paths - len(paths)
+
+    # 検索結果をパスの順番どおりに取得(workersを指定した場合は並列に検索)
+    results = iter_search_results(
+        paths,
+        matcher,
+        n_neighbors,
+        workers=workers,
+        executor=executor,
+        member_filter=member_filter,
+    )
+    with closing(results):
+        yield from results
+
+
+def iter_hits(results, stats, limit=None):
+    """search_filesの集計値をstatsに足し合わせながら、マッチしたファイルの検索結果だけを返す"""
+    n_hits = 0
+    with closing(results):
+        for hits, delta in results:
+            stats.merge(delta)
+            for hit in hits:
+                yield hit
+                n_hits += 1
+                # ヒット数にlimitを設定
+                if (limit is not None) and (n_hits == limit):
+                    return
+
+
+def timed_iter(iterable, stats, phase):
+    """要素を1つ取り出すのにかかった時間をフェーズに加算し、取り出した数を数えるイテレータ"""
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            stats.times[phase] += time.perf_counter() - start
+        stats.files_walked += 1
+        yield item
+
+
+def iter_search_results(
+    paths, word, n_neighbors, *, workers=None, executor="thread", member_filter=None
+):
+    """パスの順番どおりに(検索結果, 集計値)を返すイテレータ
+
+    workersを指定するとファイルの読み込み・パース・マッチングをプールで並列に実行する。
+    集計値はワーカーごとに1ファイル分を作って返すので、呼び出し側で足し合わせる。
+    先読みするのはworkersの数倍までなので、途中でcloseすれば残りの検索は行わない。
+    """
+    search = partial(
+        search_file, word=word, n_neighbors=n_neighbors, member_filter=member_filter
+    )
+    if (workers is None) or (workers <= 1):
+        for path in paths:
+            yield search(path)
+        return
+    if executor == "thread":
+        pool = ThreadPoolExecutor(max_workers=workers)
+    elif executor == "process":
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f"executorは'thread'か'process'を指定してください: {executor}")
+    # 投入順にfutureを保持して結果の順番を固定する
+    futures = deque()
+    try:
+        for path in paths:
+            futures.append(pool.submit(search, path))
+            if len(futures) >= workers * 4:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        # 中断された場合は未着手の検索をキャンセル
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+def lsplit_code(text, multiline=True):
+    """複数行にわたる文字列をリストにするコードを返す"""
+    # 改行文字で分割
+    text_li = text.strip().split("\n")
+    # 0文字のものは除外し、クォーテーションを付ける
+    text_li = [repr(t) for t in text_li if len(t) != 0]
+    # 結合して文字列にする
+    obj = (",").join(text_li)
+    # codeに変換
+    code = shape_code(obj, left="[", right="]", multiline=multiline)
+    return code
+
+
+def todt_code(
+    df_name, col, fmt="ymd", sep="-", new_col=None, error_handling=True, runtime=False
+):
+    """カラムをdatetime型に変換するコードを返す"""
+    if runtime is True:
+        return todt_apply_code(df_name, col, fmt, sep, new_col, error_handling)
+    # 変換対象のカラム
+    old_srs = f"{df_name}['{col}']"
+    if new_col is None:
+        new_srs = old_srs
+    else:
+        new_srs = f"{df_name}['{new_col}']"
+    # 日付形式
+    format = to_dt_format(fmt, sep)
+    # エラー対応
+    if error_handling is True:
+        tail = ", errors='coerce'"
+    else:
+        tail = ""
+    # コード作成
+    code = f"{new_srs} = pd.to_datetime({old_srs}, format='{format}'{tail})"
+    return code
+
+
+def todt_apply_code(
+    df_name, col, fmt="ymd", sep="-", new_col=None, error_handling=True
+):
+    """todt_applyでカラムをdatetime型に変換するコードを返す"""
+    cols = repr(col) if new_col is None else repr({col: new_col})
+    errors = "coerce" if error_handling is True else "raise"
+    code = (
+        f"{df_name} = ezlite.todt_apply({df_name}, {cols}, "
+        f"fmt='{fmt}', sep='{sep}', errors='{errors}')"
+    )
+    return code
+
+
+def to_dt_format(fmt, sep):
+    """ymdなどの日付形式をto_datetimeのformatに変換する
+
+    >>> to_dt_format("ymd", "-")
+    '%Y-%m-%d'
+    """
+    format = fmt.replace("y", "Y")
+    return sep.join(["%" + s for s in list(format)])
+
+
+def parse_unique_dates(srs, format, errors="coerce"):
+    """重複のない値だけをdatetime型に変換し、カテゴリのコードで元の行に戻す
+
+    日付の種類が少ない場合は行数ではなく種類の数だけ変換すれば済む。
+    """
+    from pandas import NaT, Series, factorize, to_datetime
+
+    # 欠損値のコードは-1になり、takeでNaTが入る
+    codes, uniques = factorize(srs, sort=False)
+    parsed = to_datetime(Series(uniques, dtype=object), format=format, errors=errors)
+    values = parsed.array.take(codes, allow_fill=True, fill_value=NaT)
+    return Series(values, index=srs.index, name=srs.name)
+
+
+# Windowsのドライブから始まるパス
+DRIVE_PATTERN = re.compile(r"[A-Za-z]:[\\/]")
+# パスの区切り文字(Windowsのバックスラッシュも含む)
+PATH_SEP_PATTERN = re.compile(r"[\\/]+")
+
+
+def psplit_code(path, multiline=True, trie=None):
+    """パスを環境変数を使って書き換えるコードを返す. 該当する環境変数がない場合はNone"""
+    # 引用符を削除
+    path = path.strip("'").strip('"')
+    # 絶対パスに変換(Windowsのドライブから始まるパスはそのまま使う)
+    if DRIVE_PATTERN.match(path) is None:
+        path = ref2abs(path)
+    if trie is None:
+        trie = env_trie()
+    found = match_env_prefix(trie, path)
+    if found is None:
+        return None
+    env, rest = found
+    # 環境変数以降のパスをリスト化し、環境変数部分を追加
+    obj_li = [f'os.getenv("{env}")'] + [repr(p) for p in rest]
+    # 結合して文字列にする
+    obj = (",").join(obj_li)
+    # コードに変換
+    code = shape_code(obj, left="os.path.join(", right=")", multiline=multiline)
+    return code
+
+
+def split_path(path):
+    """絶対パスを(比較用の要素のリスト, 元の要素のリスト)に分割する. 絶対パスでない場合はNone
+
+    ドライブ名は大文字小文字を区別しないので、比較用の要素は小文字にする。
+
+    >>> split_path("/home/user/")
+    (['/', 'home', 'user'], ['/', 'home', 'user'])
+    >>> split_path("C:/Users/me")
+    (['c:', 'users', 'me'], ['C:', 'Users', 'me'])
+    """
+    if DRIVE_PATTERN.match(path):
+        parts = [path[:2]] + PATH_SEP_PATTERN.split(path[3:])
+        parts = [p for p in parts if p]
+        return [p.lower() for p in parts], parts
+    if path.startswith("/"):
+        parts = ["/"] + [p for p in PATH_SEP_PATTERN.split(path) if p]
+        return parts, parts
+    return None
+
+
+def env_trie():
+    """環境変数の値(絶対パス)の要素ごとのtrieを返す. os.environが変わったときだけ作り直す"""
+    return build_env_trie(tuple(os.environ.items()))
+
+
+@lru_cache(maxsize=1)
+def build_env_trie(env_items):
+    trie = {}
+    for env, value in env_items:
+        split = split_path(value)
+        # 絶対パスでない値やルートだけの値は対象外
+        if (split is None) or (len(split[0]) < 2):
+            continue
+        node = trie
+        for part in split[0]:
+            node = node.setdefault(part, {})
+        # 同じ値の環境変数が複数ある場合は先に見つかった方を使う
+        node.setdefault(None, env)
+    return trie
+
+
+def match_env_prefix(trie, path):
+    """要素の区切りが一致する最も長い環境変数を探し、(環境変数名, 残りの要素のリスト)を返す"""
+    split = split_path(path)
+    if split is None:
+        return None
+    keys, parts = split
+    found = None
+    node = trie
+    for i, key in enumerate(keys):
+        node = node.get(key)
+        if node is None:
+            break
+        if None in node:
+            found = (node[None], parts[i + 1 :])
+    return found
+
+
+# batchで使う関数ごとの(コードを作る関数, ファイルの読み込み方)
+BATCH_BUILDERS = {
+    "lsplit": (lsplit_code, "text"),
+    "todt": (todt_code, "lines"),
+    "psplit": (psplit_code, "lines"),
+    "j": (quote_jp, "text"),
+}
+
+
+def read_batch_items(path, mode):
+    """batchの変換対象をファイルから読み込む
+
+    modeが"lines"の場合は空行以外の1行ずつ、"text"の場合はファイル全体を1つとする。
+    ノートブックの場合はコードセルを1つずつ(linesの場合はその1行ずつ)とする。
+    """
+    if path.endswith("ipynb"):
+        with open(path, encoding="utf-8") as f:
+            texts = [
+                "\n".join(source)
+                for cell_type, source in iter_notebook_cells(f)
+                if cell_type == "code"
+            ]
+    else:
+        with open(path, encoding="utf-8") as f:
+            texts = [f.read()]
+    if mode == "lines":
+        return [l.strip() for t in texts for l in t.splitlines() if l.strip()]
+    return texts
 
 
 def shape_code(obj, *, left, right, multiline=False):
@@ -233,16 +1349,6 @@ def print_2dlist(outer_li):
     return None
 
 
-def count_itr(itr, count_limit):
-    """イテレータの長さがfile_count以上ならTrueを返す"""
-    for tpl in enumerate(itr):
-        if tpl[0] < count_limit:
-            pass
-        else:
-            return count_limit
-    return tpl[0]
-
-
 def ref2abs(path):
     # 相対パスを絶対パスに変換する
     path = pathlib.Path(path)
@@ -254,24 +1360,142 @@ def pNc(code, *, pp=True):
     code = code.strip()
     print(code)
     if pp is True:
-        try:
-            pyperclip.copy(code)
-        except:
-            pass
+        # 既定ではクリップボードに別スレッドでコピーする(set_sinkで変更できる)
+        output_sink.write(code)
     return None
 
 
-def fix_sep(path):
-    # /と\の数を数える
-    slash_cnt = path.count("/")
-    bslash_cnt = path.count("\\")
+def paste_clipboard():
+    """クリップボードの内容を返す. コピー待ちがあれば終わるまで待つ"""
+    import pyperclip
+
+    output_sink.flush()
+    return pyperclip.paste()
+
+
+class ClipboardSink:
+    """pNcの出力をクリップボードにコピーする
+
+    コピーは別スレッドで行い、コピー中に書き込まれたものは最後の1つだけをコピーする。
+    backendを指定するとpyperclip.copyの代わりに呼び出す(クリップボードのない環境の確認用)。
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._pending = None
+        self._busy = False
+        self._warned = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def write(self, code):
+        with self._cond:
+            # まだコピーしていないものは捨てて最新のものだけを残す
+            self._pending = code
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="ezlite-clipboard", daemon=True
+                )
+                self._thread.start()
+                # 終了時にコピー待ちが残らないようにする
+                atexit.register(self.flush, timeout=2)
+            self._cond.notify_all()
+        return None
+
+    def flush(self, timeout=None):
+        """コピー待ちがなくなるまで待つ. タイムアウトした場合はFalse"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: (self._pending is None) and (self._busy is False), timeout
+            )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                code, self._pending = self._pending, None
+                self._busy = True
+            try:
+                self._copy(code)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _copy(self, code):
+        try:
+            backend = self.backend
+            if backend is None:
+                import pyperclip
+
+                backend = pyperclip.copy
+            backend(code)
+        except Exception as e:
+            # クリップボードが使えない環境では最初の1回だけ警告する
+            if self._warned is False:
+                self._warned = True
+                warnings.warn(f"クリップボードにコピーできませんでした: {type(e).__name__}: {e}")
+        return None
+
+
+class FileSink:
+    """pNcの出力をファイルに追記する"""
+
+    def __init__(self, path, encoding="utf-8"):
+        self.path = path
+        self.encoding = encoding
+        self._lock = threading.Lock()
+
+    def write(self, code):
+        with self._lock:
+            with open(self.path, "a", encoding=self.encoding) as f:
+                f.write(code + "\n")
+        return None
+
+    def flush(self, timeout=None):
+        return True
+
+
+class BufferSink:
+    """pNcの出力をメモリに保持する. itemsに出力した順に入る"""
+
+    def __init__(self):
+        self.items = []
+
+    def write(self, code):
+        self.items.append(code)
+        return None
+
+    def flush(self, timeout=None):
+        return True
+
+    def getvalue(self):
+        return ("\n").join(self.items)
+
+    def clear(self):
+        self.items.clear()
+        return None
+
 
-    # 多い方を区切り文字として採用する
-    if slash_cnt > bslash_cnt:
-        sep = "/"
-    elif bslash_cnt > slash_cnt:
-        sep = "\\"
-    return sep
+class NullSink:
+    """pNcの出力をどこにも出さない"""
+
+    def write(self, code):
+        return None
+
+    def flush(self, timeout=None):
+        return True
+
+
+# set_sinkで名前で指定できる出力先
+SINKS = {
+    "clipboard": ClipboardSink,
+    "file": FileSink,
+    "buffer": BufferSink,
+    "null": NullSink,
+}
+# pNcの出力先
+output_sink = ClipboardSink()
 
 
 def home_environ():
@@ -295,6 +1519,103 @@ def get_upper_dir(environ):
     return upper_dir
 
 
+def walk_paths(
+    pattern,
+    environ=None,
+    exclude=None,
+    prune_dirs=PRUNE_DIRS,
+    archives=False,
+    root=None,
+):
+    """パターンにマッチするファイルのパスを順番に返す
+
+    os.scandirで1回だけ走査し、prune_dirsやexcludeにマッチするディレクトリには入らない。
+    パターンは**と*と?が使える. []はエスケープせずにそのまま文字として扱う。
+    archivesがTrueの場合は、パターンのファイルと同じ階層にある圧縮ファイルも返す。
+    rootを指定した場合は、環境変数の親ディレクトリの代わりにrootからの相対パスとして扱う。
+    """
+    if root is None:
+        # 環境変数で親ディレクトリを取得
+        upper_dir = get_upper_dir(environ)
+        # 引数が絶対パスの場合はuppper_dirが重複するので空白に置き換え
+        pattern = pattern.replace(upper_dir + "/", "")
+        # 親ディレクトリとパターンを結合して、区切り文字を/に揃える
+        pattern = os.path.join(upper_dir, pattern).replace("\\", "/")
+        n_fixed = 0
+    else:
+        # rootはワイルドカードのような文字を含んでいてもそのまま使う
+        root_comps = os.path.abspath(root).replace("\\", "/").rstrip("/").split("/")
+        pattern = "/".join(root_comps + [pattern.replace("\\", "/")])
+        n_fixed = len(root_comps)
+    comps = pattern.split("/")
+    # ワイルドカードを含まない先頭部分を探索の起点にする
+    n_literal = n_fixed
+    for comp in comps[n_fixed:]:
+        if ("*" in comp) or ("?" in comp):
+            break
+        n_literal += 1
+    if n_literal == len(comps):
+        if os.path.isfile(pattern):
+            yield pattern
+        return
+    base_dir = "/".join(comps[:n_literal]) or "/"
+    rest = comps[n_literal:]
+    matcher = re.compile(glob_to_regex(rest))
+    # **がない場合は階層の深さで打ち切る
+    max_depth = None if "**" in rest else len(rest) - 1
+    # パターンで明示しない限り隠しファイルは対象外(globと同じ)
+    include_hidden = any(c.startswith(".") for c in rest)
+    excluders = [re.compile(glob_to_regex(e.split("/"))) for e in exclude or []]
+
+    def is_excluded(rel, name):
+        return any(e.fullmatch(rel) or e.fullmatch(name) for e in excluders)
+
+    def _walk(dirpath, rel_dir, depth):
+        try:
+            with os.scandir(dirpath) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return
+        for entry in entries:
+            name = entry.name
+            if name.startswith(".") and not include_hidden:
+                continue
+            rel = rel_dir + name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                if (name in prune_dirs) or is_excluded(rel, name):
+                    continue
+                if (max_depth is None) or (depth < max_depth):
+                    yield from _walk(entry.path, rel + "/", depth + 1)
+            elif is_excluded(rel, name):
+                continue
+            elif matcher.fullmatch(rel):
+                yield entry.path
+            elif archives and is_archive(name):
+                # 圧縮ファイルはパターンのファイルと同じ階層のものだけを返す
+                if (max_depth is None) or (depth == max_depth):
+                    yield entry.path
+
+    yield from _walk(base_dir, "", 0)
+
+
+def glob_to_regex(comps):
+    """/で分割したglobパターンを正規表現の文字列に変換する"""
+    parts = []
+    for i, comp in enumerate(comps):
+        is_last = i + 1 == len(comps)
+        if comp == "**":
+            # 0個以上のディレクトリ(末尾の場合は任意のファイル)
+            parts.append(".+" if is_last else "(?:[^/]+/)*")
+            continue
+        part = re.escape(comp).replace(r"\*", "[^/]*").replace(r"\?", "[^/]")
+        parts.append(part if is_last else part + "/")
+    return "".join(parts)
+
+
 def get_lines(path):
     if path.endswith("ipynb"):
         lines = parse_ipynb(path)
@@ -303,55 +1624,937 @@ def get_lines(path):
     return lines
 
 
-def parse_ipynb(path):
-    with open(path, encoding="utf-8") as f:
-        try:
-            jsn = json.load(f)
-            # セルの情報をリストに格納
-            cells = jsn["cells"]
-            # セルからコード部分のみ取得
-            cell_codes = [c["source"] for c in cells]
-            # 1行ごとにリストに追加
-            lines = []
-            for codes in cell_codes:
-                for c in codes:
-                    lines.append(c)
-            # 末尾の改行文字を削除
-            lines = [l[:-1] if l.endswith("\n") else l for l in lines]
-        except:
-            return None
+def parse_ipynb(path, with_cells=False, stats=None):
+    """ノートブックのセルのソースを1行ずつリストにする
+
+    出力(画像など)は読み飛ばすので、巨大なノートブックでもソース分のメモリしか使わない。
+    with_cellsがTrueの場合は、各セルの開始行のリストもあわせて返す。
+    読み込めない場合はNoneを返し、statsを渡した場合は失敗として記録する。
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            size = os.fstat(f.fileno()).st_size
+            lines, cell_starts = read_notebook_lines(f)
+        if stats is not None:
+            stats.bytes_read += size
+            stats.notebooks_parsed += 1
+    except (OSError, ValueError) as e:
+        # UnicodeDecodeErrorもValueErrorに含まれる
+        lines, cell_starts = None, None
+        if stats is not None:
+            stats.add_failure(path, e)
+    if with_cells is True:
+        return lines, cell_starts
     return lines
 
 
-def parse_text(path):
-    with open(path, "r", encoding="utf-8") as f:
-        try:
-            lines = re.split("[\n|\r|\r\n]", f.read())
-        except:
-            return []
+def read_notebook_lines(f):
+    """ノートブックのファイルオブジェクトから(ソースの行のリスト, 各セルの開始行のリスト)を返す"""
+    lines, cell_starts = [], []
+    for _cell_type, source in iter_notebook_cells(f):
+        cell_starts.append(len(lines))
+        lines.extend(source)
+    return lines, cell_starts
+
+
+def iter_notebook_cells(f, max_chars=NOTEBOOK_MAX_CHARS):
+    """ノートブックのファイルオブジェクトから(セルの種類, ソースの行リスト)を順番に返す"""
+    stream = JsonStream(f)
+    n_chars = 0
+    found = False
+    for key in stream.iter_object():
+        if key != "cells":
+            stream.skip_value()
+            continue
+        found = True
+        for _ in stream.iter_array():
+            cell_type, source = None, []
+            for cell_key in stream.iter_object():
+                if cell_key == "cell_type":
+                    cell_type = stream.read_string()
+                elif cell_key == "source":
+                    source = read_notebook_source(stream)
+                else:
+                    # outputsやmetadataは保持せずに読み飛ばす
+                    stream.skip_value()
+            n_chars += sum(len(l) for l in source)
+            if n_chars > max_chars:
+                raise ValueError(f"セルのソースが{max_chars}文字を超えています。")
+            yield cell_type, source
+    if found is False:
+        raise ValueError("cellsがありません。")
+
+
+def read_notebook_source(stream):
+    """セルのsource(文字列か文字列のリスト)を行のリストにする"""
+    if stream.peek() == '"':
+        return stream.read_string().split("\n")
+    lines = []
+    for _ in stream.iter_array():
+        line = stream.read_string()
+        # 末尾の改行文字を削除
+        lines.append(line[:-1] if line.endswith("\n") else line)
     return lines
 
 
+class JsonStream:
+    """ファイルをチャンクごとに読みながらJSONを先頭から走査する
+
+    読み飛ばした値はバッファから捨てるので、巨大な文字列があってもメモリはチャンク分で済む。
+    """
+
+    _ws = re.compile(r"\s*")
+    _str_body = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+    _special = re.compile(r'["\[\]{}]')
+    _scalar = re.compile(r"[^,\]}\s]*")
+
+    def __init__(self, f, chunk_size=NOTEBOOK_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+
+    def _fill(self):
+        # 読み終わった部分を捨てて次のチャンクを追加する
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """空白を読み飛ばして次の文字を返す"""
+        while True:
+            self.pos = self._ws.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("JSONが途中で終わっています。")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"{char}が必要な位置に{self.buf[self.pos]}があります。")
+        self.pos += 1
+
+    def _scan_string(self, keep):
+        self.expect('"')
+        parts = []
+        while True:
+            end = self._str_body.match(self.buf, self.pos).end()
+            if keep:
+                parts.append(self.buf[self.pos : end])
+            self.pos = end
+            if (end < len(self.buf)) and (self.buf[end] == '"'):
+                self.pos += 1
+                break
+            # 閉じ引用符がチャンクの外にある(エスケープ途中の\はバッファに残る)
+            if not self._fill():
+                raise ValueError("文字列が途中で終わっています。")
+        if not keep:
+            return None
+        raw = "".join(parts)
+        if "\\" not in raw:
+            return raw
+        return json.loads('"' + raw + '"')
+
+    def read_string(self):
+        return self._scan_string(keep=True)
+
+    def skip_value(self):
+        """次の値を保持せずに読み飛ばす"""
+        char = self.peek()
+        if char == '"':
+            self._scan_string(keep=False)
+        elif char in "[{":
+            depth = 0
+            while True:
+                m = self._special.search(self.buf, self.pos)
+                if m is None:
+                    self.pos = len(self.buf)
+                    if not self._fill():
+                        raise ValueError("JSONが途中で終わっています。")
+                    continue
+                self.pos = m.start()
+                if m.group() == '"':
+                    # バッファ内で閉じている文字列はまとめて読み飛ばす
+                    end = self._str_body.match(self.buf, self.pos + 1).end()
+                    if (end < len(self.buf)) and (self.buf[end] == '"'):
+                        self.pos = end + 1
+                    else:
+                        self._scan_string(keep=False)
+                    continue
+                self.pos += 1
+                depth += 1 if m.group() in "[{" else -1
+                if depth == 0:
+                    break
+        else:
+            # 数値やtrue/false/null
+            while True:
+                end = self._scalar.match(self.buf, self.pos).end()
+                if end < len(self.buf):
+                    self.pos = end
+                    break
+                if not self._fill():
+                    self.pos = end
+                    break
+
+    def iter_object(self):
+        """オブジェクトのキーを順番に返す. 値は呼び出し側で読むか読み飛ばす"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_string()
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"オブジェクトの区切りが不正です: {char}")
+
+    def iter_array(self):
+        """配列の要素ごとにNoneを返す. 要素は呼び出し側で読むか読み飛ばす"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield None
+            char = self.peek()
+            self.pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"配列の区切りが不正です: {char}")
+
+
+def parse_text(path, stats=None):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            size = os.fstat(f.fileno()).st_size
+            text = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        # 読み込めないファイルは空として扱い、statsを渡した場合は失敗として記録する
+        if stats is not None:
+            stats.add_failure(path, e)
+        return []
+    if stats is not None:
+        stats.bytes_read += size
+    lines = re.split("[\n|\r|\r\n]", text)
+    return lines
+
+
+def read_text_lines(path, stats=None):
+    """search_textと同じ区切りとデコードでテキストファイルを行のリストにする
+
+    改行文字だけで区切り、デコードできないバイトは置き換える。バイナリファイルは空のリストにする。
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        if stats is not None:
+            stats.add_failure(path, e)
+        return []
+    if b"\0" in data[:8192]:
+        if stats is not None:
+            stats.files_skipped += 1
+        return []
+    if stats is not None:
+        stats.bytes_read += len(data)
+    return [decode_line(line) for line in data.split(b"\n")]
+
+
 def get_matched_idxs(lines, word):
     """サーチする文字列が含まれるリストの番号を返す"""
+    matcher = to_matcher(word)
     idxs_matched = []
     if lines:
         for idx, line in enumerate(lines):
-            if word in line:
+            if matcher.search(line):
                 idxs_matched.append(idx)
             else:
                 pass
     return idxs_matched
 
 
-def collect_neighbors(num_list, n_neighbors):
-    """リストの各数値の前後nの範囲の数値を追加して重複を除外する
-    >>> collect_neighbor([2, 10], 1, 2)
-    [1, 2, 3, 4, 9, 10, 11, 12]
+def merge_neighbors(num_list, n_neighbors, n_lines=None):
+    """昇順の各数値の前後nの範囲を、重なるか隣り合うものどうしでまとめる
+    >>> merge_neighbors([2, 4, 10], 1)
+    [(1, 6), (9, 12)]
     """
-    collected_list = []
+    ranges = []
     for num in num_list:
-        for diff in range(-n_neighbors, n_neighbors + 1):
-            collected_list.append(num + diff)
-    collected_list = sorted(list(set(collected_list)))
-    return collected_list
+        start = max(num - n_neighbors, 0)
+        end = num + n_neighbors + 1
+        if n_lines is not None:
+            end = min(end, n_lines)
+        if ranges and (start <= ranges[-1][1]):
+            # 前の範囲と重なるか隣り合う場合は延長
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def to_trigrams(lines):
+    """行のリストに含まれる3文字の部分文字列を集合で返す"""
+    trigrams = set()
+    for line in lines or []:
+        trigrams.update(line[i : i + 3] for i in range(len(line) - 2))
+    return trigrams
+
+
+def open_sniff_index(index_path=None):
+    """trigramインデックスのDBに接続する(なければ作成する)"""
+    if index_path is None:
+        index_path = SNIFF_INDEX_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    con = sqlite3.connect(index_path)
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS trigrams (
+            tri TEXT NOT NULL,
+            file_id INTEGER NOT NULL,
+            PRIMARY KEY (tri, file_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS trigrams_file_id ON trigrams (file_id);
+        """
+    )
+    (version,) = con.execute("PRAGMA user_version").fetchone()
+    if version != SNIFF_INDEX_VERSION:
+        with con:
+            con.execute("DELETE FROM trigrams")
+            con.execute("DELETE FROM files")
+            con.execute(f"PRAGMA user_version = {SNIFF_INDEX_VERSION}")
+    return con
+
+
+def refresh_sniff_index(con, paths):
+    """更新日時かサイズが変わったファイルだけインデックスを作り直す
+
+    Returns:
+        tuple: (対象ファイル数, 登録し直したファイル数)
+    """
+    indexed = {
+        path: (file_id, mtime_ns, size)
+        for file_id, path, mtime_ns, size in con.execute(
+            "SELECT id, path, mtime_ns, size FROM files"
+        )
+    }
+    n_files, n_updated = 0, 0
+    with con:
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            n_files += 1
+            row = indexed.pop(path, None)
+            if (row is not None) and (row[1:] == (st.st_mtime_ns, st.st_size)):
+                # 変更がないファイルは読まない
+                continue
+            if row is not None:
+                con.execute("DELETE FROM trigrams WHERE file_id = ?", (row[0],))
+                con.execute("DELETE FROM files WHERE id = ?", (row[0],))
+            file_id = con.execute(
+                "INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+                (path, st.st_mtime_ns, st.st_size),
+            ).lastrowid
+            con.executemany(
+                "INSERT INTO trigrams (tri, file_id) VALUES (?, ?)",
+                ((tri, file_id) for tri in to_trigrams(index_lines(path))),
+            )
+            n_updated += 1
+        # 削除されたファイルはインデックスからも削除
+        for path, (file_id, _, _) in indexed.items():
+            if not os.path.exists(path):
+                con.execute("DELETE FROM trigrams WHERE file_id = ?", (file_id,))
+                con.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    return n_files, n_updated
+
+
+def index_lines(path):
+    """インデックスに登録する行のリストを返す. 検索時と同じ方法で読み込んで、ヒットを取りこぼさないようにする"""
+    if path.endswith("ipynb"):
+        return parse_ipynb(path)
+    return read_text_lines(path)
+
+
+def query_sniff_index(con, word):
+    """検索文字列のtrigramをすべて含むファイルパスの集合を返す
+
+    リストの場合はいずれかの文字列を含みうるファイルの集合を返す。
+    3文字未満の文字列があると絞り込めないのでNoneを返す。
+    """
+    if not isinstance(word, str):
+        paths = set()
+        for w in word:
+            _paths = query_sniff_index(con, w)
+            if _paths is None:
+                return None
+            paths |= _paths
+        return paths
+    trigrams = to_trigrams([word])
+    if not trigrams:
+        return None
+    placeholders = ",".join("?" * len(trigrams))
+    rows = con.execute(
+        f"""
+        SELECT f.path FROM trigrams t JOIN files f ON f.id = t.file_id
+        WHERE t.tri IN ({placeholders})
+        GROUP BY t.file_id HAVING COUNT(*) = ?
+        """,
+        (*trigrams, len(trigrams)),
+    )
+    return {path for (path,) in rows}
+
+
+def open_history_db(db_path=None):
+    """実行履歴のDBに接続する(なければ作成する)
+
+    FTS5のtrigramトークナイザーが使える場合は全文検索用のテーブルも作成する。
+    """
+    if db_path is None:
+        db_path = HISTORY_DB_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    con = sqlite3.connect(db_path)
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS cells (
+            id INTEGER PRIMARY KEY,
+            hash TEXT UNIQUE NOT NULL,
+            code TEXT NOT NULL,
+            notebook TEXT,
+            first_run_at REAL NOT NULL,
+            last_run_at REAL NOT NULL,
+            n_runs INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE INDEX IF NOT EXISTS cells_last_run_at ON cells (last_run_at);
+        """
+    )
+    try:
+        con.executescript(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS cells_fts USING fts5(
+                code, content='cells', content_rowid='id',
+                tokenize='trigram case_sensitive 1'
+            );
+            CREATE TRIGGER IF NOT EXISTS cells_ai AFTER INSERT ON cells BEGIN
+                INSERT INTO cells_fts (rowid, code) VALUES (new.id, new.code);
+            END;
+            CREATE TRIGGER IF NOT EXISTS cells_ad AFTER DELETE ON cells BEGIN
+                INSERT INTO cells_fts (cells_fts, rowid, code)
+                VALUES ('delete', old.id, old.code);
+            END;
+            """
+        )
+    except sqlite3.OperationalError:
+        # FTS5やtrigramが使えないSQLiteでは部分一致で検索する
+        pass
+    return con
+
+
+def has_history_fts(con):
+    row = con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cells_fts'"
+    ).fetchone()
+    return row is not None
+
+
+def add_history(con, code, notebook=None):
+    """実行したコードを記録する. 同じコードはハッシュで判定して実行日時と回数だけ更新する"""
+    code_hash = hashlib.sha1(code.encode("utf-8")).hexdigest()
+    now = time.time()
+    with con:
+        con.execute(
+            """
+            INSERT INTO cells (hash, code, notebook, first_run_at, last_run_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (hash) DO UPDATE SET
+                last_run_at = excluded.last_run_at,
+                notebook = excluded.notebook,
+                n_runs = n_runs + 1
+            """,
+            (code_hash, code, notebook, now, now),
+        )
+    return None
+
+
+def query_history(con, word=None, n=20, desc=True):
+    """記録したコードを実行日時の順に最大n件返す. wordを指定した場合はそれを含むものだけ"""
+    order = "DESC" if desc else "ASC"
+    if word is None:
+        rows = con.execute(
+            f"SELECT code FROM cells ORDER BY last_run_at {order} LIMIT ?", (n,)
+        )
+    elif (len(word) >= 3) and has_history_fts(con):
+        # trigramの全文検索で候補を絞り込んでから部分一致を確認
+        phrase = '"' + word.replace('"', '""') + '"'
+        rows = con.execute(
+            f"""
+            SELECT code FROM cells
+            WHERE id IN (SELECT rowid FROM cells_fts WHERE cells_fts MATCH ?)
+                AND instr(code, ?) > 0
+            ORDER BY last_run_at {order} LIMIT ?
+            """,
+            (phrase, word, n),
+        )
+    else:
+        rows = con.execute(
+            f"""
+            SELECT code FROM cells WHERE instr(code, ?) > 0
+            ORDER BY last_run_at {order} LIMIT ?
+            """,
+            (word, n),
+        )
+    return [code for (code,) in rows]
+
+
+class HistoryRecorder:
+    """IPythonのpost_run_cellイベントで実行したセルをDBに記録する"""
+
+    def __init__(self, ip, con):
+        self.ip = ip
+        self.con = con
+
+    def __call__(self, result):
+        code = result.info.raw_cell
+        if not code.strip():
+            return None
+        # VS Codeの場合はノートブックのパスがわかる
+        notebook = self.ip.user_ns.get("__vsc_ipynb_file__") or os.getenv(
+            "JPY_SESSION_NAME"
+        )
+        add_history(self.con, code, notebook=notebook)
+        return None
+
+
+class FrameView:
+    """DataFrameをページごとに切り出す. 並べ替えと絞り込みの結果は行位置の配列で保持する"""
+
+    def __init__(self, df, columns=None, page_size=100, profile_html=""):
+        self.df = df
+        self.columns = list(df.columns) if columns is None else list(columns)
+        self.page_size = page_size
+        self.profile_html = profile_html
+        # 直近の(並べ替え, 昇順, 絞り込み)の行位置
+        self._cache_key = None
+        self._cache_positions = None
+
+    def positions(self, sort=None, asc=True, q=""):
+        """並べ替えと絞り込みをした行位置を返す. どちらもない場合はNone"""
+        import numpy as np
+
+        if (sort is None) and (not q):
+            return None
+        key = (sort, asc, q)
+        if key == self._cache_key:
+            return self._cache_positions
+        df = self.df
+        positions = np.arange(len(df))
+        if q:
+            # 表示するカラムのいずれかに文字列を含む行だけを残す
+            mask = np.zeros(len(df), dtype=bool)
+            for col in self.columns:
+                srs = df[col].astype(str)
+                mask |= srs.str.contains(q, regex=False, na=False).to_numpy()
+            positions = positions[mask]
+        if sort is not None:
+            srs = df[sort].iloc[positions].reset_index(drop=True)
+            order = srs.sort_values(ascending=asc, kind="stable").index.to_numpy()
+            positions = positions[order]
+        self._cache_key, self._cache_positions = key, positions
+        return positions
+
+    def page(self, page=0, sort=None, asc=True, q=""):
+        """ページのHTMLと行数、ページ数を辞書で返す"""
+        positions = self.positions(sort=sort, asc=asc, q=q)
+        n_rows = len(self.df) if positions is None else len(positions)
+        n_pages = max((n_rows - 1) // self.page_size + 1, 1)
+        page = min(max(page, 0), n_pages - 1)
+        start = page * self.page_size
+        end = start + self.page_size
+        if positions is None:
+            df_page = self.df.iloc[start:end]
+        else:
+            df_page = self.df.iloc[positions[start:end]]
+        return {
+            "html": df_page[self.columns].to_html(),
+            "page": page,
+            "n_pages": n_pages,
+            "n_rows": n_rows,
+        }
+
+
+class FrameViewHandler(BaseHTTPRequestHandler):
+    """FrameViewのページを返すHTTPハンドラ"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        view = self.server.view
+        if url.path == "/":
+            columns = "".join(
+                f"<option>{html.escape(str(c))}</option>" for c in view.columns
+            )
+            body = FRAME_VIEW_HTML.replace("{columns}", columns)
+            body = body.replace("{profile}", view.profile_html)
+            self._send(body, "text/html")
+        elif url.path == "/rows":
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            sort = params.get("sort") or None
+            if (sort is not None) and (sort not in view.df.columns):
+                # カラム名が文字列でない場合は表示名から探す
+                sort = next((c for c in view.columns if str(c) == sort), None)
+            try:
+                body = view.page(
+                    page=int(params.get("page", 0)),
+                    sort=sort,
+                    asc=params.get("asc", "1") == "1",
+                    q=params.get("q", ""),
+                )
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self._send(json.dumps(body), "application/json")
+        else:
+            self.send_error(404)
+
+    def _send(self, body, content_type):
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # アクセスログは表示しない
+        pass
+
+
+def remove_file(path):
+    """ファイルを削除する. 既に削除されている場合は何もしない"""
+    with suppress(FileNotFoundError):
+        os.remove(path)
+    return None
+
+
+def serve_dataframe(df, columns=None, page_size=100, profile_html=""):
+    """DataFrameをページごとに返すサーバーのURLを返す
+
+    サーバーは初回だけ別スレッドで起動して使い回し、表示するDataFrameを差し替える。
+    前に表示していたDataFrameへの参照は残らない。
+    """
+    global frame_server
+    view = FrameView(df, columns=columns, page_size=page_size, profile_html=profile_html)
+    with frame_server_lock:
+        if frame_server is None:
+            server = ThreadingHTTPServer(("127.0.0.1", 0), FrameViewHandler)
+            server.daemon_threads = True
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            frame_server = server
+        frame_server.view = view
+    host, port = frame_server.server_address[:2]
+    return f"http://{host}:{port}/"
+
+
+FRAME_VIEW_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>df_viewer</title>
+<style>
+body { font-family: sans-serif; font-size: 13px; }
+#controls { position: sticky; top: 0; background: #fff; padding: 6px 0; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #ccc; padding: 2px 6px; white-space: nowrap; }
+</style>
+</head>
+<body>
+<div id="controls">
+<button id="prev">&lt;</button>
+<span id="status"></span>
+<button id="next">&gt;</button>
+並べ替え <select id="sort"><option value=""></option>{columns}</select>
+<label><input type="checkbox" id="asc" checked>昇順</label>
+絞り込み <input id="q">
+</div>
+{profile}
+<div id="table"></div>
+<script>
+let page = 0, nPages = 1;
+function load() {
+  const params = new URLSearchParams({
+    page: page,
+    sort: document.getElementById("sort").value,
+    asc: document.getElementById("asc").checked ? "1" : "0",
+    q: document.getElementById("q").value,
+  });
+  fetch("/rows?" + params).then(r => r.json()).then(data => {
+    page = data.page;
+    nPages = data.n_pages;
+    document.getElementById("table").innerHTML = data.html;
+    document.getElementById("status").textContent =
+      (page + 1) + " / " + nPages + " ページ (" + data.n_rows + " 行)";
+  });
+}
+document.getElementById("prev").onclick = () => { if (page > 0) { page--; load(); } };
+document.getElementById("next").onclick = () => { if (page + 1 < nPages) { page++; load(); } };
+document.getElementById("sort").onchange = () => { page = 0; load(); };
+document.getElementById("asc").onchange = () => { page = 0; load(); };
+document.getElementById("q").onchange = () => { page = 0; load(); };
+load();
+</script>
+</body>
+</html>
+"""
+
+
+def profile_frame(df, sample=None):
+    """カラムごとの型、欠損数、異なる値の数、最小値、最大値、頻出値をDataFrameで返す
+
+    欠損数と最小値・最大値は同じ型のカラムをまとめて1回で計算する。
+    異なる値の数は行数が多い場合はHyperLogLogで推定する。
+    結果はDataFrameのフィンガープリントごとに保持するので、同じDataFrameは再計算しない。
+    """
+    from pandas import DataFrame
+
+    fingerprint = frame_fingerprint(df)
+    key = None if fingerprint is None else (fingerprint, sample)
+    if key in profile_cache:
+        profile_cache.move_to_end(key)
+        return profile_cache[key]
+
+    if (sample is not None) and (len(df) > sample):
+        df = df.sample(sample, random_state=0)
+    # 頻出値はサンプリングした行で数える
+    df_top = df
+    if len(df_top) > PROFILE_TOP_SAMPLE:
+        df_top = df_top.sample(PROFILE_TOP_SAMPLE, random_state=0)
+
+    stats = {}
+    # 同じ型のカラムごとにまとめて計算する
+    dtype_groups = {}
+    for i, dtype in enumerate(df.dtypes):
+        dtype_groups.setdefault(str(dtype), []).append(i)
+    for dtype, idxs in dtype_groups.items():
+        sub = df.iloc[:, idxs]
+        nulls = sub.isna().sum().to_numpy()
+        mins, maxs = [None] * len(idxs), [None] * len(idxs)
+        if sub.dtypes.iloc[0].kind in "biufmM":
+            with warnings.catch_warnings():
+                # すべて欠損のカラムの警告は出さない
+                warnings.simplefilter("ignore", RuntimeWarning)
+                mins = sub.min().to_numpy()
+                maxs = sub.max().to_numpy()
+        for k, i in enumerate(idxs):
+            values = df.iloc[:, i]
+            try:
+                top = df_top.iloc[:, i].value_counts().head(3)
+            except TypeError:
+                # リストや辞書などハッシュできない値はreprの文字列にして数える
+                srs_top = df_top.iloc[:, i].map(repr, na_action="ignore")
+                top = srs_top.value_counts().head(3)
+            stats[i] = {
+                "column": df.columns[i],
+                "dtype": dtype,
+                "nulls": int(nulls[k]),
+                "distinct": approx_distinct(values.dropna().to_numpy()),
+                "min": mins[k],
+                "max": maxs[k],
+                "top": ", ".join(f"{v} ({n})" for v, n in top.items()),
+            }
+    profile = DataFrame([stats[i] for i in range(df.shape[1])]).set_index("column")
+
+    if key is not None:
+        profile_cache[key] = profile
+        if len(profile_cache) > PROFILE_CACHE_SIZE:
+            profile_cache.popitem(last=False)
+    return profile
+
+
+def approx_distinct(values, p=14):
+    """異なる値の数を返す. 行数が多い場合はHyperLogLogで推定する"""
+    import numpy as np
+    from pandas.util import hash_array
+
+    if len(values) < PROFILE_HLL_MIN_ROWS:
+        try:
+            return len(set(values))
+        except TypeError:
+            # ハッシュできない値はHyperLogLogで数える
+            pass
+    try:
+        hashes = hash_array(values)
+    except TypeError:
+        # リストなどを含む場合はastype(str)もできないので、1つずつreprの文字列にする
+        hashes = hash_array(np.array([repr(v) for v in values], dtype=object))
+    m = 1 << p
+    # 上位pビットでレジスタを決め、残りのビットの先頭の0の数+1を記録する
+    idx = (hashes >> np.uint64(64 - p)).astype(np.intp)
+    rest = hashes & np.uint64((1 << (64 - p)) - 1)
+    # restは53ビット未満なのでfloatに変換しても正確にビット長がわかる
+    _, bit_length = np.frexp(rest.astype(np.float64))
+    rank = (64 - p) - bit_length + 1
+    registers = np.zeros(m, dtype=np.int64)
+    np.maximum.at(registers, idx, rank)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.power(2.0, -registers))
+    n_zeros = np.count_nonzero(registers == 0)
+    if (estimate <= 2.5 * m) and (n_zeros > 0):
+        # 少ない場合は線形カウントで補正
+        estimate = m * np.log(m / n_zeros)
+    return int(round(estimate))
+
+
+def load_msort_cache():
+    """msort_treeのキャッシュを読み込む. isortのバージョンが変わった場合は空にする"""
+    import isort
+
+    try:
+        with open(MSORT_CACHE_PATH, encoding="utf-8") as f:
+            msort_cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if msort_cache.get("isort") != isort.__version__:
+        return {}
+    return msort_cache.get("files", {})
+
+
+def save_msort_cache(msort_cache):
+    import isort
+
+    os.makedirs(os.path.dirname(MSORT_CACHE_PATH), exist_ok=True)
+    write_atomic(
+        MSORT_CACHE_PATH,
+        json.dumps({"isort": isort.__version__, "files": msort_cache}),
+    )
+    return None
+
+
+def write_atomic(path, text):
+    """書き込み途中で壊れないように同じディレクトリの一時ファイルから置き換える"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        if os.path.exists(path):
+            # 元のファイルの権限を引き継ぐ
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return None
+
+
+def file_signature(path):
+    """キャッシュと比較する(更新日時, サイズ)"""
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def isort_config(settings_path):
+    # ルートにあるpyproject.tomlなどのisortの設定を使う. 設定の変更を反映するため毎回読み込む
+    import isort
+
+    return isort.Config(settings_path=settings_path)
+
+
+def isort_config_digest(config):
+    """読み込んだisortの設定のハッシュ. 設定ファイルを変えた場合にキャッシュを使わないようにする"""
+
+    def _default(value):
+        # 集合は実行ごとに順番が変わるので並べ替える
+        if isinstance(value, (set, frozenset)):
+            return sorted(map(str, value))
+        return str(value)
+
+    settings = {k: v for k, v in vars(config).items() if not k.startswith("_")}
+    text = json.dumps(settings, sort_keys=True, default=_default)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def sort_code_cells(text, config):
+    """ノートブックのコードセルのimport文をsortする. 変更がない場合はNone
+
+    %や!から始まる行があるセルはisortが解釈できないのでそのままにする。
+    """
+    import isort
+
+    nb = json.loads(text)
+    changed = False
+    for cell in nb.get("cells", []):
+        if cell.get("cell_type") != "code":
+            continue
+        source = cell.get("source", [])
+        code = source if isinstance(source, str) else "".join(source)
+        if any(l.lstrip().startswith(("%", "!")) for l in code.splitlines()):
+            continue
+        # セルの末尾には改行がないのでisortが付けた改行を戻す
+        sorted_code = isort.code(code, config=config)
+        if not code.endswith("\n"):
+            sorted_code = sorted_code.rstrip("\n")
+        if sorted_code != code:
+            cell["source"] = sorted_code.splitlines(keepends=True)
+            changed = True
+    if changed is False:
+        return None
+    # Jupyterと同じ形式で保存する
+    return json.dumps(nb, indent=1, ensure_ascii=False) + "\n"
+
+
+def sort_imports_file(path, config):
+    """ファイルのimport文をsortして上書きし、(パス, 書き換えたかどうか, 署名, ハッシュ, エラー)を返す"""
+    import isort
+
+    try:
+        with open(path, encoding="utf-8", newline="") as f:
+            text = f.read()
+        if path.endswith(".ipynb"):
+            sorted_text = sort_code_cells(text, config)
+        else:
+            sorted_text = isort.code(text, config=config, file_path=pathlib.Path(path))
+            if sorted_text == text:
+                sorted_text = None
+        if sorted_text is not None:
+            write_atomic(path, sorted_text)
+            text = sorted_text
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return path, sorted_text is not None, file_signature(path), digest, None
+    except Exception as e:
+        return path, False, None, None, f"{type(e).__name__}: {e}"
+
+
+def is_sorted_cached(path, entry, config_digest):
+    """キャッシュに記録した後にファイルとisortの設定が変わっていないかどうか
+
+    更新日時とサイズが同じならそのまま、違う場合は中身のハッシュで比較する。
+    """
+    if (entry is None) or (entry[2:] != [config_digest]):
+        return False
+    try:
+        signature = file_signature(path)
+        if signature == entry[0]:
+            return True
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return False
+    if digest == entry[1]:
+        # touchされただけなので署名を更新する
+        entry[0] = signature
+        return True
+    return False
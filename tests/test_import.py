@@ -0,0 +1,12 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_does_not_import_pandas():
+    # 既にpandasを読み込んだプロセスでは確かめられないので、新しいインタプリタで実行する
+    code = "import ezlite, sys; assert 'pandas' not in sys.modules"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, check=True)